@@ -1,58 +1,241 @@
-from dataclasses import dataclass
-from typing import  Union, Any, Callable
-
-from chonkie import BaseEmbeddings
-from numpy import ndarray, array, matmul, linalg
+from asyncio import Semaphore, gather, sleep, to_thread
+from collections.abc import Iterator, AsyncIterator
+from json import loads
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from pathlib import PosixPath
+from typing import  Union, Any, Callable, Optional, TYPE_CHECKING
 
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# chonkie and numpy are only needed to chunk stories, so they are imported when a story is chunked
+if TYPE_CHECKING:
+	from chonkie import BaseEmbeddings
+	from numpy import ndarray
+	from embedcache import EmbeddingCache
+
+# worth retrying: the server is restarting, overloaded or behind a proxy which lost it
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def retrying_session(retries: int, backoff: float, pool: int) -> Session:
+	"""
+	A keep-alive session which retries connection errors and 5xx responses with exponential backoff
+	"""
+	session = Session()
+	# allowed_methods=None retries POST too, every request here is idempotent
+	retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES, allowed_methods=None,
+				  raise_on_status=False)
+	adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	return session
+
+
+class AsyncBackend:
+	"""
+	A pooled httpx client for one server, which limits the requests in flight to it and retries connection errors and
+	5xx responses with exponential backoff. The client is made on first use, in the event loop that uses it.
+	"""
+	def __init__(self, base_url: str, concurrency: int, timeout: float, retries: int, backoff: float):
+		self.base_url = base_url
+		self.concurrency = concurrency
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.client = None
+		self.semaphore = None
+
+	def connect(self):
+		if self.client is None:
+			from httpx import AsyncClient, Limits
+			self.client = AsyncClient(base_url=self.base_url, timeout=self.timeout,
+									  limits=Limits(max_connections=self.concurrency))
+			self.semaphore = Semaphore(self.concurrency)
+
+	async def post(self, path: str, body: dict) -> Any:
+		from httpx import TransportError
+		self.connect()
+		async with self.semaphore:
+			for attempt in range(self.retries + 1):
+				last_attempt = attempt == self.retries
+				try:
+					resp = await self.client.post(path, json=body)
+					if resp.status_code not in RETRY_STATUSES or last_attempt:
+						resp.raise_for_status()
+						return resp.json()
+				except TransportError: # refused, reset or timed out
+					if last_attempt:
+						raise
+				await sleep(self.backoff * 2 ** attempt)
+
+	async def stream_lines(self, path: str, body: dict) -> AsyncIterator[str]:
+		"""
+		post, then yield the response line by line as it arrives, only retried until the first line
+		"""
+		from httpx import TransportError
+		self.connect()
+		async with self.semaphore:
+			started = False
+			for attempt in range(self.retries + 1):
+				last_attempt = attempt == self.retries
+				try:
+					async with self.client.stream("POST", path, json=body) as resp:
+						if resp.status_code not in RETRY_STATUSES or last_attempt:
+							resp.raise_for_status()
+							async for line in resp.aiter_lines():
+								started = True
+								yield line
+							return
+				except TransportError:
+					if last_attempt or started:
+						raise
+				await sleep(self.backoff * 2 ** attempt)
+
+	async def aclose(self):
+		if self.client is not None:
+			await self.client.aclose()
+			self.client = None
+
 
+class LocalTokenizer:
+	"""
+	Counts tokens in process with a Hugging Face tokenizer instead of asking the server
+	:param source: a tokenizer.json file or a Hugging Face repo with one, e.g. Qwen/Qwen3-Embedding-0.6B
+	:param special_tokens: count BOS/EOS as well, STAPI does while llama.cpp's /tokenize does not
+	"""
+	def __init__(self, source: str, special_tokens: bool = False, cache_size: int = 65536):
+		from tokenizers import Tokenizer
+		if PosixPath(source).expanduser().is_file():
+			self.tokenizer = Tokenizer.from_file(str(PosixPath(source).expanduser()))
+		else:
+			self.tokenizer = Tokenizer.from_pretrained(source)
+		self.special_tokens = special_tokens
+		# the same chunks are counted again for every question about a story
+		self.count_tokens = lru_cache(maxsize=cache_size)(self._count_tokens)
+
+	def _count_tokens(self, text: str) -> int:
+		return len(self.tokenizer.encode(text, add_special_tokens=self.special_tokens))
+
+	def count_tokens_batch(self, texts: list[str]) -> list[int]:
+		return [self.count_tokens(text) for text in texts]
 
 
 @dataclass
-class STAPIEmbeddings(BaseEmbeddings):
+class STAPIEmbeddings:
+	"""
+	Embeddings from STAPI, chunker_embeddings() is the same as a chonkie BaseEmbeddings for SemanticChunker
+	"""
 	def get_tokenizer_or_token_counter(self) -> Union[Any, Callable[[str], int]]:
 		return self.count_tokens
 
+	# what newer chonkie versions call it
+	get_tokenizer = get_tokenizer_or_token_counter
+
 	host: str
+	cache: Optional["EmbeddingCache"] = None
+	tokenizer: Optional[LocalTokenizer] = None
+	timeout: float = 60
+	# requests in flight from the async methods
+	concurrency: int = 4
+	retries: int = 3
+	backoff: float = 0.5
 
 	def __post_init__(self):
-		self.sesh = Session() # for keep-alive
+		self.sesh = retrying_session(self.retries, self.backoff, self.concurrency)
+		self.backend = AsyncBackend(self.host, self.concurrency, self.timeout, self.retries, self.backoff)
+		self.chunker = None
 
 	def _embed(self, text: Union[str, list[str]]):
 		body = {
 			"model": "ignored",
 			"input": text
 		}
-		resp = self.sesh.post(f"{self.host}/v1/embeddings", json=body)
+		resp = self.sesh.post(f"{self.host}/v1/embeddings", json=body, timeout=self.timeout)
 		return resp.json()
 
+	async def _aembed(self, texts: list[str]):
+		return await self.backend.post("/v1/embeddings", {"model": "ignored", "input": texts})
+
 	def count_tokens(self, text: str) -> int:
+		if self.tokenizer:
+			return self.tokenizer.count_tokens(text)
 		body = {
 			"model": "ignored",
 			"input": text
 		}
-		resp = self.sesh.post(f"{self.host}/v1/tokenize", json=body)
+		resp = self.sesh.post(f"{self.host}/v1/tokenize", json=body, timeout=self.timeout)
 		return resp.json()["usage"]["prompt_tokens"]
 
-	def embed(self, text: str) -> ndarray:
-		resp = self._embed(text)
-		embedded = resp["data"][0]["embedding"]
+	def cache_lookup(self, texts: list[str], prompt: str) -> tuple[list, list[int]]:
+		"""
+		:return: the cached embedding or None of each text, indices of the texts which STAPI has to embed
+		"""
+		if self.cache is None:
+			found = [None] * len(texts)
+		else:
+			found = self.cache.get_many(texts, prompt)
+		return found, [i for i, embedding in enumerate(found) if embedding is None]
+
+	def cache_fill(self, texts: list[str], prompt: str, found: list, missing: list[int], resp: dict):
+		fetched = [embedding["embedding"] for embedding in resp["data"]]
+		if self.cache is not None:
+			self.cache.put_many([texts[i] for i in missing], fetched, prompt)
+		for i, embedding in zip(missing, fetched):
+			found[i] = embedding
+
+	def cached_embed(self, texts: list[str], prompt: str = "") -> list[list[float]]:
+		# only the texts which are not in the cache are sent to STAPI
+		found, missing = self.cache_lookup(texts, prompt)
+		if missing:
+			resp = self._embed([prompt + texts[i] for i in missing])
+			self.cache_fill(texts, prompt, found, missing, resp)
+		return found
+
+	async def acached_embed(self, texts: list[str], prompt: str = "") -> list[list[float]]:
+		# the SQLite cache blocks, so it is read and written in a thread instead of the event loop
+		found, missing = await to_thread(self.cache_lookup, texts, prompt)
+		if missing:
+			resp = await self._aembed([prompt + texts[i] for i in missing])
+			await to_thread(self.cache_fill, texts, prompt, found, missing, resp)
+		return found
+
+	def chunker_embeddings(self) -> "BaseEmbeddings":
+		"""
+		:return: this embedder as a chonkie BaseEmbeddings, sharing the cache and tokenizer
+		"""
+		if isinstance(self, chonkie_embeddings_class()):
+			return self
+		if self.chunker is None:
+			settings = {field.name: getattr(self, field.name) for field in fields(self)}
+			self.chunker = chonkie_embeddings_class()(**settings)
+		return self.chunker
+
+	def embed(self, text: str) -> "ndarray":
+		from numpy import array
+		embedded = self.cached_embed([text])[0]
 		return array([embedded])
 
-	def embed_batch(self, texts: list[str]) -> list[ndarray]:
-		resp = self._embed(texts)
+	def embed_batch(self, texts: list[str]) -> list["ndarray"]:
+		from numpy import array
 		embeddings = [
-			array(embedding["embedding"])
-			for embedding in resp["data"]
+			array(embedding)
+			for embedding in self.cached_embed(texts)
 		]
 		return embeddings
 
 	def count_tokens_batch(self, texts: list[str]) -> list[int]:
+		if self.tokenizer:
+			return self.tokenizer.count_tokens_batch(texts)
 		body = {
 			"model": "ignored",
 			"input": texts
 		}
-		resp = self.sesh.post(f"{self.host}/v1/tokenize", json=body)
+		resp = self.sesh.post(f"{self.host}/v1/tokenize", json=body, timeout=self.timeout)
 		counts = [
 			len(tokens["embedding"])
 			for tokens in resp.json()["data"]
@@ -60,7 +243,8 @@ class STAPIEmbeddings(BaseEmbeddings):
 		return counts
 		#return super().count_tokens_batch(texts)
 
-	def similarity(self, u: ndarray, v: ndarray) -> float:
+	def similarity(self, u: "ndarray", v: "ndarray") -> float:
+		from numpy import matmul, linalg
 		# https://numpy.org/doc/stable/reference/generated/numpy.dot.html#numpy.dot
 		# If both a and b are 2-D arrays, it is matrix multiplication, but using matmul or a @ b is preferred.
 		numerator = matmul(u, v.T) #i do not understand why it needs .T
@@ -71,39 +255,88 @@ class STAPIEmbeddings(BaseEmbeddings):
 	def dimension(self) -> int:
 		return 1024
 
-	def final_embed(self, texts: list[str]) -> list[list[int]]:
-		resp = self._embed(texts)
-		embeddings = [
-			embedding["embedding"]
-			for embedding in resp["data"]
-		]
-		return embeddings
+	def final_embed(self, texts: list[str], prompt: str = "") -> list[list[int]]:
+		"""
+		:param prompt: instruction prefixed to every text, e.g. the s2p prompt for questions, it is part of the cache key
+		"""
+		return self.cached_embed(texts, prompt)
+
+	async def afinal_embed(self, texts: list[str], prompt: str = "") -> list[list[float]]:
+		return await self.acached_embed(texts, prompt)
+
+	async def aclose(self):
+		await self.backend.aclose()
+
+
+@lru_cache(maxsize=1)
+def chonkie_embeddings_class() -> type:
+	"""
+	STAPIEmbeddings with chonkie's BaseEmbeddings as a base, made on first use so that only chunking imports chonkie
+	"""
+	from chonkie import BaseEmbeddings
+
+	class ChonkieSTAPIEmbeddings(STAPIEmbeddings, BaseEmbeddings):
+		pass
+
+	return ChonkieSTAPIEmbeddings
 
 @dataclass
 class LlamacppAPI:
 	base_url: str
+	tokenizer: Optional[LocalTokenizer] = None
+	# concurrent /tokenize requests of count_tokens_batch without a local tokenizer
+	workers: int = 8
+	# answers from a large context take a while
+	timeout: float = 600
+	# requests in flight from the async methods, llama-server --parallel
+	concurrency: int = 1
+	retries: int = 3
+	backoff: float = 0.5
 
 	def __post_init__(self):
 		self.base_url = self.base_url.rstrip("/")
-		self.session = Session()
-		resp = self.session.get(f"{self.base_url}/props")
+		self.session = retrying_session(self.retries, self.backoff, self.workers)
+		self.backend = AsyncBackend(self.base_url, self.concurrency, self.timeout, self.retries, self.backoff)
+		resp = self.session.get(f"{self.base_url}/props", timeout=self.timeout)
 		self.context = resp.json()["default_generation_settings"]["n_ctx"]
+		# tokenizing doesn't take a generation slot, so it isn't limited by concurrency
+		self.tokenize_backend = AsyncBackend(self.base_url, self.workers, self.timeout, self.retries, self.backoff)
+		self.remote_count = lru_cache(maxsize=4096)(self._remote_count)
 
 	def tokenize(self, content: str) -> list[int]:
-		resp = self.session.post(f"{self.base_url}/tokenize", json={"content": content})
+		resp = self.session.post(f"{self.base_url}/tokenize", json={"content": content}, timeout=self.timeout)
 		return resp.json()["tokens"]
 
-	def count_tokens(self, content: str) -> int:
+	def _remote_count(self, content: str) -> int:
 		return len(self.tokenize(content))
 
+	def count_tokens(self, content: str) -> int:
+		if self.tokenizer:
+			return self.tokenizer.count_tokens(content)
+		return self.remote_count(content)
+
+	def count_tokens_batch(self, contents: list[str]) -> list[int]:
+		if self.tokenizer:
+			return self.tokenizer.count_tokens_batch(contents)
+		# /tokenize takes one content per request, so send them side by side
+		with ThreadPoolExecutor(max_workers=self.workers) as pool:
+			return list(pool.map(self.remote_count, contents))
+
+	async def acount_tokens_batch(self, contents: list[str]) -> list[int]:
+		if self.tokenizer:
+			return self.tokenizer.count_tokens_batch(contents)
+		responses = await gather(*(self.tokenize_backend.post("/tokenize", {"content": content}) for content in contents))
+		return [len(resp["tokens"]) for resp in responses]
+
 	def completion(self, prompt: Union[str, list[str], list[int], dict[str, Any]]) -> dict[str, str]:
-		resp = self.session.post(f"{self.base_url}/completion", json={"prompt": prompt})
+		resp = self.session.post(f"{self.base_url}/completion", json={"prompt": prompt}, timeout=self.timeout)
 		return resp.json()
 
 	def chat_response(self, prompt: Union[str, list[str], list[int], dict[str, Any]]) -> str:
 		return self.completion(prompt)["content"]
 
-	def completion2(self, system_prompt, user_prompt):
+	@staticmethod
+	def chat_body(system_prompt: str, user_prompt: str) -> dict:
 		body = {
 			"messages": [
 				{
@@ -115,9 +348,61 @@ class LlamacppAPI:
 				}
 			]
 		}
-		resp = self.session.post(f"{self.base_url}/v1/chat/completions", json=body)
+		return body
+
+	def completion2(self, system_prompt, user_prompt):
+		body = self.chat_body(system_prompt, user_prompt)
+		resp = self.session.post(f"{self.base_url}/v1/chat/completions", json=body, timeout=self.timeout)
 		return resp.json()
 
 	def chat_response2(self, system: str, question: str):
 		completion = self.completion2(system, question)
 		return completion["choices"][0]["message"]["content"]
+
+	@staticmethod
+	def sse_content(line: str) -> Optional[str]:
+		"""
+		:return: the text in a server-sent chunk of a streamed chat completion, "" at the end, None for anything else
+		"""
+		if not line.startswith("data: "):
+			return None
+		data = line.removeprefix("data: ").strip()
+		if data == "[DONE]":
+			return ""
+		choice = loads(data)["choices"][0]
+		return choice["delta"].get("content") or None
+
+	def stream_response2(self, system: str, question: str) -> Iterator[str]:
+		"""
+		chat_response2, yielding the answer piece by piece while llama.cpp generates it
+		"""
+		body = self.chat_body(system, question) | {"stream": True}
+		with self.session.post(f"{self.base_url}/v1/chat/completions", json=body, timeout=self.timeout,
+							   stream=True) as resp:
+			resp.raise_for_status()
+			# requests falls back to ISO-8859-1 for text/event-stream without a charset, but SSE is always UTF-8
+			resp.encoding = "utf-8"
+			for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+				content = self.sse_content(line)
+				if content == "":
+					return
+				if content:
+					yield content
+
+	async def achat_response2(self, system: str, question: str) -> str:
+		completion = await self.backend.post("/v1/chat/completions", self.chat_body(system, question))
+		return completion["choices"][0]["message"]["content"]
+
+	async def astream_response2(self, system: str, question: str) -> AsyncIterator[str]:
+		body = self.chat_body(system, question) | {"stream": True}
+		# closed right away at [DONE], or the semaphore and the stream are held until the generator is collected
+		async with aclosing(self.backend.stream_lines("/v1/chat/completions", body)) as lines:
+			async for line in lines:
+				content = self.sse_content(line)
+				if content == "":
+					return
+				if content:
+					yield content
+
+	async def aclose(self):
+		await gather(self.backend.aclose(), self.tokenize_backend.aclose())
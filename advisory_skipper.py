@@ -1,10 +1,9 @@
 from pathlib import Path
-from struct import iter_unpack
-from lzma import decompress
-from base64 import b64decode
 
 from typing import Iterator
 
+from idsets import decode_ids
+
 
 # this is a compressed list of fics from the "foalcon advisory," see below for how it is generated
 skipblob = """
@@ -47,15 +46,8 @@ ijAoAgAAAAAA4y0iUMJU3oMAAc0PvBQAAOi0+KCxxGf7AgAAAAAEWVo="""
 
 
 def generate_skips(blob: str = skipblob) -> Iterator[int]:
-	compressed_blob_b64 = blob.encode("ascii")
-	compressed_blob = b64decode(compressed_blob_b64)
-	bytestream = decompress(compressed_blob)
-	encoded_skips = iter_unpack("<H", bytestream)
-	first_id = next(encoded_skips)[0]
-	yield first_id
-	for adds in encoded_skips:
-		first_id += adds[0]
-		yield first_id
+	# see idsets.StoryIdSet for membership tests that don't depend on the order of the stories
+	yield from decode_ids(blob)
 
 
 if __name__ == "__main__":
@@ -67,14 +59,11 @@ if __name__ == "__main__":
 	Any found pairs are stored as a list of story IDs, and then transformed into a blob which can be pasted in code
 	"""
 	from tomllib import loads
-	from itertools import pairwise
-	from struct import pack
-	from lzma import compress
-	from base64 import encodebytes
 	from bs4 import BeautifulSoup
 	from esdocs import Story
 	from elasticsearch_dsl import connections
 	from Levenshtein import ratio #pip install levenshtein
+	from idsets import encode_ids
 
 	my_config_path = Path(__file__).with_suffix(".ini")
 	my_config = loads(my_config_path.read_text())
@@ -126,12 +115,5 @@ if __name__ == "__main__":
 				# likely success: "When Things Change [Deleted]" -> "When Things Change (Deleted Scenes)"
 				# probably the 298 failures actually deleted and not in fimfarchive. good enough
 				failures.append({"id": author_id, "title": story_title, "hits": [hit._source["title"] for hit in res.hits.hits]})
-	ids_found.sort() # thanks to the FiMFarchive for being ordered sequentially by story ID for this trick
-	first = ids_found[0]
-	deltas = list(map(lambda pair: pair[1] - pair[0], pairwise(ids_found)))
-	compress_this = [first]
-	compress_this.extend(deltas)
-	blob = pack(f"<{len(compress_this)}H", *compress_this)
-	compressed_blob = compress(blob)
-	b64 = encodebytes(compressed_blob).decode("ascii")
+	b64 = encode_ids(ids_found)
 	print(b64)
@@ -0,0 +1,65 @@
+"""
+Check that the search side modules import quickly and without the ingest-only dependencies.
+Each module is imported in a fresh interpreter with python -X importtime, and the script exits non-zero when a
+module goes over its budget or pulls in a heavy module, so it can gate a commit or a CI job.
+Run it as: python check_import_time.py (--budget-scale 2 on a slow machine)
+"""
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import PosixPath
+
+# cumulative import time budget in milliseconds, measured cold, elasticsearch itself is most of it
+BUDGETS = {
+	"esdocs": 1000,
+	"rag_cli": 1500,
+	# nicegui (fastapi, starlette, uvicorn) is most of it
+	"vaguesearch": 2500,
+}
+
+# the ingest and statistics dependencies, which the search side should only load on demand
+HEAVY_MODULES = ("statsmodels", "scipy", "pandas", "bs4", "ebooklib", "pony", "chonkie")
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+	"""
+	:return: cumulative import time of the module in ms, heavy modules that it imported
+	"""
+	probe = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], capture_output=True, text=True,
+							cwd=PosixPath(__file__).parent)
+	if result.returncode != 0:
+		raise SystemExit(f"importing {module} failed:\n{result.stderr}")
+	cumulative_us = 0
+	for line in result.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		fields = line.split("|")
+		if len(fields) == 3 and fields[2].strip() == module:
+			cumulative_us = int(fields[1])
+	loaded = set(result.stdout.split())
+	heavy = [name for name in HEAVY_MODULES if name in loaded]
+	return cumulative_us / 1000, heavy
+
+
+if __name__ == "__main__":
+	configuration = ArgumentParser(description="Enforce the import time budgets of the search side modules")
+	configuration.add_argument("modules", nargs="*", default=list(BUDGETS), help="modules to check (default: all)")
+	configuration.add_argument("--budget-scale", type=float, default=1.0, help="multiply every budget by this")
+	configuration.add_argument("--repeat", type=int, default=3, help="the best of this many runs is compared")
+	args = configuration.parse_args()
+
+	failed = False
+	for module in args.modules:
+		budget = BUDGETS.get(module, 1000) * args.budget_scale
+		runs = [measure(module) for _ in range(args.repeat)]
+		best = min(elapsed for elapsed, _ in runs)
+		heavy = runs[0][1]
+		status = "ok"
+		if best > budget:
+			status = "OVER BUDGET"
+			failed = True
+		if heavy:
+			status = f"imports {', '.join(heavy)}"
+			failed = True
+		print(f"{module:<12} {best:>8.1f} ms (budget {budget:.0f} ms) {status}")
+	sys.exit(1 if failed else 0)
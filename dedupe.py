@@ -0,0 +1,213 @@
+from dataclasses import dataclass
+from time import perf_counter
+
+import numpy as np
+
+from typing import Iterator, Optional
+
+from esdocs import Chapter, Story, Duplicate
+
+MAX_HASH = np.uint32(0xFFFFFFFF)
+
+
+@dataclass
+class MinHasher:
+	"""
+	MinHash signatures of the word shingles of a text, with multiply-shift hashing vectorized by numpy.
+	Word hashes come from hash(), they are only comparable within one process, which is all that ingest needs.
+	"""
+	num_perm: int = 64
+	shingle_words: int = 5
+	block_size: int = 2048 # shingles hashed at once, bounds the temporary arrays to num_perm * block_size * 8 bytes
+	seed: int = 1
+
+	def __post_init__(self):
+		rng = np.random.default_rng(self.seed)
+		self.multipliers = rng.integers(1, 2**63, self.num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+		self.increments = rng.integers(0, 2**63, self.num_perm, dtype=np.uint64)
+		self.shingle_base = np.uint64(1099511628211) # FNV prime
+
+	def shingles(self, text: str) -> np.ndarray:
+		words = text.split()
+		word_hashes = np.fromiter(map(hash, words), dtype=np.int64, count=len(words)).view(np.uint64)
+		if not len(word_hashes):
+			return word_hashes
+		# a text shorter than a shingle is one shingle of all its words
+		shingle_count = max(len(word_hashes) - self.shingle_words + 1, 1)
+		shingle_words = min(len(word_hashes), self.shingle_words)
+		shingles = np.zeros(shingle_count, dtype=np.uint64)
+		for offset in range(shingle_words):
+			shingles = shingles * self.shingle_base + word_hashes[offset:offset + shingle_count]
+		return np.unique(shingles)
+
+	def signature(self, text: str) -> Optional[np.ndarray]:
+		shingles = self.shingles(text)
+		if not len(shingles):
+			return None
+		signature = np.full(self.num_perm, MAX_HASH, dtype=np.uint32)
+		for block_start in range(0, len(shingles), self.block_size):
+			block = shingles[block_start:block_start + self.block_size]
+			hashed = (self.multipliers[:, None] * block[None, :] + self.increments[:, None]) >> np.uint64(32)
+			np.minimum(signature, hashed.min(axis=1).astype(np.uint32), out=signature)
+		return signature
+
+
+class LSHIndex:
+	"""
+	Banded locality sensitive hashing over MinHash signatures, in preallocated arrays: memory is bounded by capacity.
+	Each item costs num_perm * 4 bytes of signature, bands * 8 bytes of band hashes and 16 bytes of keys, and another
+	bands bytes while finding the candidate pairs.
+	"""
+	def __init__(self, num_perm: int = 64, bands: int = 16, capacity: int = 300_000, seed: int = 2):
+		assert num_perm % bands == 0, "the signature must split evenly into bands"
+		self.bands = bands
+		self.rows = num_perm // bands
+		self.capacity = capacity
+		self.count = 0
+		self.overflow = 0
+		self.signatures = np.empty((capacity, num_perm), dtype=np.uint32)
+		self.band_hashes = np.empty((capacity, bands), dtype=np.uint64)
+		self.keys = np.empty((capacity, 2), dtype=np.int64)
+		rng = np.random.default_rng(seed)
+		self.row_multipliers = rng.integers(1, 2**63, self.rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+	def add(self, key: tuple[int, int], signature: np.ndarray) -> bool:
+		if self.count >= self.capacity:
+			self.overflow += 1
+			return False
+		self.signatures[self.count] = signature
+		banded = signature.reshape(self.bands, self.rows).astype(np.uint64)
+		self.band_hashes[self.count] = (banded * self.row_multipliers).sum(axis=1)
+		self.keys[self.count] = key
+		self.count += 1
+		return True
+
+	def band_buckets(self, band: int) -> tuple[np.ndarray, np.ndarray]:
+		"""
+		:return: the items sorted by their hash in band, and where each bucket of equal hashes starts
+		"""
+		band_hashes = self.band_hashes[:self.count, band]
+		order = np.argsort(band_hashes, kind="stable")
+		return order, np.flatnonzero(np.diff(band_hashes[order])) + 1
+
+	def candidate_pairs(self, threshold: float = 0.8, max_bucket: int = 100) -> Iterator[tuple[tuple, tuple, float]]:
+		"""
+		Pairs of items sharing at least one band, with an estimated Jaccard similarity of at least threshold.
+		Buckets larger than max_bucket (e.g. boilerplate author's notes) are skipped.
+		"""
+		# whether each item's bucket in each band is compared, bands bytes per item
+		compared = np.empty((self.count, self.bands), dtype=bool)
+		for band in range(self.bands):
+			order, run_starts = self.band_buckets(band)
+			run_lengths = np.diff(np.concatenate(([0], run_starts, [self.count])))
+			compared[order, band] = np.repeat((run_lengths >= 2) & (run_lengths <= max_bucket), run_lengths)
+		for band in range(self.bands):
+			order, run_starts = self.band_buckets(band)
+			for bucket in np.split(order, run_starts):
+				if len(bucket) < 2 or len(bucket) > max_bucket:
+					continue
+				bucket = np.sort(bucket)
+				firsts, seconds = np.triu_indices(len(bucket), k=1)
+				firsts, seconds = bucket[firsts], bucket[seconds]
+				# a pair is only compared in the first band the two share a compared bucket, instead of remembering
+				# the pairs seen
+				shared = self.band_hashes[firsts, :band] == self.band_hashes[seconds, :band]
+				earlier = (shared & compared[firsts, :band]).any(axis=1)
+				firsts, seconds = firsts[~earlier], seconds[~earlier]
+				similarities = (self.signatures[firsts] == self.signatures[seconds]).mean(axis=1)
+				for first, second, similarity in zip(firsts, seconds, similarities):
+					if similarity >= threshold:
+						yield tuple(self.keys[first]), tuple(self.keys[second]), float(similarity)
+
+
+class NearDuplicates:
+	"""
+	Finds near duplicate stories (or chapters) across the ingest in one pass.
+	A story's signature is the element-wise minimum of its chapters' signatures, which is the signature of their union.
+	"""
+	def __init__(self, level: str = "story", capacity: int = 300_000, threshold: float = 0.8):
+		self.level = level
+		self.threshold = threshold
+		self.hasher = MinHasher()
+		self.index = LSHIndex(self.hasher.num_perm, capacity=capacity)
+		self.story_signature: Optional[np.ndarray] = None
+		self.hashed_chars = 0
+		self.hashing_seconds = 0.0
+
+	def add_chapter(self, chapter: Chapter):
+		start = perf_counter()
+		signature = self.hasher.signature(chapter.chapter.text or "")
+		self.hashing_seconds += perf_counter() - start
+		self.hashed_chars += len(chapter.chapter.text or "")
+		if signature is None:
+			return
+		if self.level == "chapter":
+			self.index.add((chapter.story.id, chapter.chapter.id or -1), signature)
+		elif self.story_signature is None:
+			self.story_signature = signature
+		else:
+			np.minimum(self.story_signature, signature, out=self.story_signature)
+
+	def add_story(self, story: Story):
+		if self.level == "story" and self.story_signature is not None:
+			self.index.add((story.id, -1), self.story_signature)
+		self.story_signature = None
+
+	def start_story(self):
+		# drops the chapters of a story that was skipped part way
+		self.story_signature = None
+
+	def documents(self) -> Iterator[Duplicate]:
+		for first, second, similarity in self.index.candidate_pairs(self.threshold):
+			duplicate = Duplicate()
+			duplicate.level = self.level
+			duplicate.stories = [int(first[0]), int(second[0])]
+			if self.level == "chapter":
+				duplicate.chapters = [int(first[1]), int(second[1])]
+			duplicate.similarity = similarity
+			yield duplicate
+
+	def report(self) -> str:
+		throughput = self.hashed_chars / 2**20 / self.hashing_seconds if self.hashing_seconds else 0
+		report = f"MinHashed {self.hashed_chars / 2**20:.0f} MB of text at {throughput:.1f} MB/s, {self.index.count} {self.level} signatures"
+		if self.index.overflow:
+			report += f", {self.index.overflow} over capacity were not indexed"
+		return report
+
+
+if __name__ == "__main__":
+	from argparse import ArgumentParser
+	from random import Random
+	configuration = ArgumentParser(description="Throughput and recall benchmark of the MinHash/LSH stage on synthetic text")
+	configuration.add_argument("--docs", type=int, default=5000)
+	configuration.add_argument("--words", type=int, default=3000, help="words per document")
+	configuration.add_argument("--duplicates", type=int, default=200, help="planted near duplicates (1%% of words changed)")
+	configuration.add_argument("--threshold", type=float, default=0.8)
+	args = configuration.parse_args()
+
+	rng = Random(42)
+	vocabulary = [f"w{i}" for i in range(20000)]
+	texts = [" ".join(rng.choices(vocabulary, k=args.words)) for _ in range(args.docs)]
+	planted = set()
+	for copy in range(args.duplicates):
+		original = rng.randrange(args.docs)
+		words = texts[original].split()
+		for _ in range(len(words) // 100):
+			words[rng.randrange(len(words))] = rng.choice(vocabulary)
+		planted.add((original, len(texts)))
+		texts.append(" ".join(words))
+
+	hasher = MinHasher()
+	index = LSHIndex(hasher.num_perm, capacity=len(texts))
+	start = perf_counter()
+	for i, text in enumerate(texts):
+		index.add((i, -1), hasher.signature(text))
+	hashed = perf_counter() - start
+	start = perf_counter()
+	found = {(first[0], second[0]) for first, second, _ in index.candidate_pairs(args.threshold)}
+	paired = perf_counter() - start
+	megabytes = sum(map(len, texts)) / 2**20
+	print(f"{len(texts)} docs, {megabytes:.0f} MB: {len(texts) / hashed:.0f} docs/s, {megabytes / hashed:.1f} MB/s, "
+		  f"candidate pairs in {paired:.2f}s")
+	print(f"recall {len(found & planted) / len(planted):.1%}, {len(found - planted)} unplanted pairs, "
+		  f"{index.signatures.nbytes + index.band_hashes.nbytes + index.keys.nbytes} bytes of index")
@@ -0,0 +1,110 @@
+"""
+A persistent, content addressed cache of embeddings, so that the same text is only sent to the embedding server once.
+Entries are keyed on the model name, the prompt prefix and the text, and the vectors are stored as float16 (or
+float32) blobs in SQLite. Once the cache is larger than its cap, the least recently used entries are evicted.
+"""
+import logging
+from hashlib import blake2b
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+from time import time
+from typing import Union
+
+from numpy import frombuffer, asarray
+
+cachelogger = logging.getLogger("embedcache")
+
+
+class EmbeddingCache:
+	def __init__(self, path: Path, model: str, max_megabytes: float = 2048, dtype: str = "float16"):
+		if dtype not in ("float16", "float32"):
+			raise ValueError(f"Unsupported embedding cache dtype {dtype}, choose float16 or float32")
+		self.model = model
+		self.dtype = dtype
+		self.max_bytes = int(max_megabytes * 2**20)
+		self.hits = 0
+		self.misses = 0
+		# the web UI embeds from worker threads
+		self.lock = Lock()
+		Path(path).parent.mkdir(parents=True, exist_ok=True)
+		self.db = connect(Path(path), check_same_thread=False)
+		self.db.execute("pragma journal_mode=wal")
+		self.db.execute('create table if not exists "embeddings" ("key" blob primary key, "dtype" text not null, '
+						'"vector" blob not null, "last_used" real not null)')
+		self.db.execute('create index if not exists "idx_embeddings__last_used" on "embeddings" ("last_used")')
+		self.db.commit()
+		self.size = self.db.execute('select coalesce(sum(length("vector")), 0) from "embeddings"').fetchone()[0]
+
+	def key(self, text: str, prompt: str) -> bytes:
+		hasher = blake2b(digest_size=20)
+		for part in (self.model, prompt, text):
+			encoded = part.encode()
+			# length prefixed, so that the parts can't run into each other
+			hasher.update(len(encoded).to_bytes(8, "little"))
+			hasher.update(encoded)
+		return hasher.digest()
+
+	def get_many(self, texts: list[str], prompt: str = "") -> list[Union[list[float], None]]:
+		"""
+		:return: the cached embedding of each text, or None where it is not cached
+		"""
+		keys = [self.key(text, prompt) for text in texts]
+		found = {}
+		with self.lock:
+			for start in range(0, len(keys), 500):
+				batch = keys[start:start + 500]
+				placeholders = ", ".join("?" * len(batch))
+				rows = self.db.execute(f'select "key", "dtype", "vector" from "embeddings" where "key" in ({placeholders})',
+									   batch)
+				for key, dtype, vector in rows:
+					found[key] = frombuffer(vector, dtype=dtype).astype("float32").tolist()
+			now = time()
+			self.db.executemany('update "embeddings" set "last_used" = ? where "key" = ?', [(now, key) for key in found])
+			self.db.commit()
+			self.hits += len(found)
+			self.misses += len(keys) - len(found)
+		return [found.get(key) for key in keys]
+
+	def put_many(self, texts: list[str], vectors: list[list[float]], prompt: str = ""):
+		now = time()
+		# by key, so a text given twice is only counted once, as it is only stored once
+		rows = {}
+		for text, vector in zip(texts, vectors):
+			key = self.key(text, prompt)
+			rows[key] = (key, self.dtype, asarray(vector, dtype=self.dtype).tobytes(), now)
+		rows = list(rows.values())
+		with self.lock:
+			for key, _, vector, _ in rows:
+				previous = self.db.execute('select length("vector") from "embeddings" where "key" = ?', (key, )).fetchone()
+				self.size += len(vector) - (previous[0] if previous else 0)
+			self.db.executemany('insert or replace into "embeddings" ("key", "dtype", "vector", "last_used") '
+								'values (?, ?, ?, ?)', rows)
+			if self.size > self.max_bytes:
+				self.evict()
+			self.db.commit()
+
+	def evict(self):
+		# down to 90% of the cap, so that eviction doesn't run on every insert
+		target = self.max_bytes * 0.9
+		evicted = []
+		for key, size in self.db.execute('select "key", length("vector") from "embeddings" order by "last_used"'):
+			if self.size <= target:
+				break
+			evicted.append((key, ))
+			self.size -= size
+		self.db.executemany('delete from "embeddings" where "key" = ?', evicted)
+		cachelogger.info(f"Evicted {len(evicted)} embeddings from the cache")
+
+	@property
+	def hit_rate(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	def report(self) -> str:
+		return (f"embedding cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), "
+				f"{self.size / 2**20:.1f} of {self.max_bytes / 2**20:.0f} MB")
+
+	def close(self):
+		with self.lock:
+			self.db.close()
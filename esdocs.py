@@ -1,15 +1,19 @@
 import logging
+from collections import OrderedDict
 from datetime import datetime, UTC
-from itertools import pairwise
-from bs4 import BeautifulSoup
+from itertools import pairwise, batched
+from sys import getsizeof
+from threading import Lock
 
 from elasticsearch import dsl as es_dsl_types
 from elasticsearch.dsl import Q
 from elasticsearch.exceptions import NotFoundError
-from ebooklib.epub import EpubHtml
-from statsmodels.stats.proportion import proportion_confint
-from typing import Union, Iterable, SupportsIndex
-from folders import GroupInfo
+from typing import Union, Iterable, SupportsIndex, TYPE_CHECKING
+
+# ingest-only dependencies are imported where they are used, so that the search tools start quickly
+if TYPE_CHECKING:
+	from ebooklib.epub import EpubHtml
+	from grouplookup import GroupInfo
 
 class DocStoryAuthor(es_dsl_types.InnerDoc):
 	id = es_dsl_types.Integer(meta={"source": "author.id"})
@@ -57,11 +61,13 @@ class DocChapter(es_dsl_types.InnerDoc):
 class Chapter(es_dsl_types.Document):
 	chapter = es_dsl_types.Object(DocChapter)
 	story = es_dsl_types.Object(DocStory)
+	# the story fields that chapters keep in the lean layout, enough to filter and sort chapters without stories-*
+	lean_story_fields = ("id", "tags", "content_rating", "completion_status", "published", "score")
 
 	class Index:
 		name = "chapters-*"
 		settings = {
-			#"codec": "best_compression", #compression slows it down by 1/5 and reduces the index size by 1/3
+			# see INDEX_PROFILES for best_compression and other size/speed tradeoffs
 			"number_of_replicas": 0,
 			#"refresh_interval": "60s",
 			"query": {"default_field": "story.title"}
@@ -75,6 +81,7 @@ class Chapter(es_dsl_types.Document):
 		self.story.score.dislikes = down
 		self.story.score.ratio = (up - down) / votes
 
+		from statsmodels.stats.proportion import proportion_confint
 		lower, upper = proportion_confint(up, votes, 0.01, method="wilson")
 		self.story.score.wilson99 = lower
 		lower, upper = proportion_confint(up, votes, 0.03, method="wilson")
@@ -103,7 +110,7 @@ class Chapter(es_dsl_types.Document):
 		posterior_mean = posterior_a / (posterior_a + posterior_b)
 		return posterior_mean, left_endpoint, right_endpoint
 
-	def fill_story_author_meta(self, story_meta: dict, groups_info: Union[GroupInfo, bool]):
+	def fill_story_author_meta(self, story_meta: dict, groups_info: Union["GroupInfo", bool]):
 		self.story.author.id = story_meta["author"]["id"]
 		self.story.author.name = story_meta["author"]["name"]
 		self.story.words = story_meta["num_words"]
@@ -157,7 +164,7 @@ class Chapter(es_dsl_types.Document):
 				h1.clear() #small % chance to remove an actual in-story <h1>... meh
 				return title
 
-	def analyze(self, chapter, story_meta: dict, chapters_data: list, groups_info: Union[GroupInfo, bool]):
+	def analyze(self, chapter, story_meta: dict, chapters_data: list, groups_info: Union["GroupInfo", bool]):
 		self.fill_story_author_meta(story_meta, groups_info)
 		if chapter.number >= 0:
 			self.fill_chapter_meta_full(chapter.title, chapter.number, chapters_data[chapter.number])
@@ -179,7 +186,8 @@ class Chapter(es_dsl_types.Document):
 		else:
 			self.eat_simple_chapter(chapter.href, chapter.title)
 
-	def eat_multi_chapter(self, chapters: list[EpubHtml], title: str):
+	def eat_multi_chapter(self, chapters: list["EpubHtml"], title: str):
+		from bs4 import BeautifulSoup
 		first_chapter_dom = BeautifulSoup(chapters[0].get_content(), "lxml-xml")
 		self.try_to_remove_title(first_chapter_dom, title)
 		for chapter in chapters[1:]:
@@ -188,7 +196,8 @@ class Chapter(es_dsl_types.Document):
 			first_chapter_dom.body.extend(next_chapter_dom.body)
 		self.chapter.text = first_chapter_dom.body.get_text(" ")  # da magics
 
-	def eat_simple_chapter(self, chapter: EpubHtml, title: str):
+	def eat_simple_chapter(self, chapter: "EpubHtml", title: str):
+		from bs4 import BeautifulSoup
 		chapter_dom = BeautifulSoup(chapter.get_content(), "lxml-xml")
 		self.try_to_remove_title(chapter_dom, title)
 		self.chapter.text = chapter_dom.body.get_text(" ")  # da magics
@@ -200,6 +209,31 @@ class Chapter(es_dsl_types.Document):
 			if h1.text == title:
 				h1.clear()
 
+	def leaned(self) -> "Chapter":
+		"""
+		A copy of this chapter for the lean layout, where the rest of the story metadata lives only in stories-*
+		"""
+		lean = Chapter(chapter=self.chapter)
+		for field in self.lean_story_fields:
+			setattr(lean.story, field, getattr(self.story, field))
+		lean.story.author.id = self.story.author.id
+		return lean
+
+	@classmethod
+	def join_stories(cls, chapters: Iterable["Chapter"]) -> list["Chapter"]:
+		"""
+		Fill in the story metadata of lean chapters from stories-*, with one search for all of their stories
+		"""
+		chapters = list(chapters)
+		stories = Story.lookup({chapter.story.id for chapter in chapters})
+		for chapter in chapters:
+			story = stories.get(chapter.story.id)
+			if story is None:
+				continue
+			for attr in Story.story_fields:
+				setattr(chapter.story, attr, getattr(story, attr))
+		return chapters
+
 	@classmethod
 	def get_multi_texts(cls, story_id: int, chapter_nos: Iterable[int]) -> dict[int, str]:
 		chapter_matches = [
@@ -220,6 +254,133 @@ class Chapter(es_dsl_types.Document):
 		}
 		return chapter_texts
 
+
+class ChapterTextCache:
+	"""
+	Texts of recently used chapters by (story ID, chapter number), so that asking about a story again fetches no
+	chapters. The least recently used texts are dropped once they take more than max_megabytes.
+	"""
+	def __init__(self, max_megabytes: float = 256):
+		self.max_bytes = int(max_megabytes * 2**20)
+		self.size = 0
+		self.texts: OrderedDict[tuple[int, int], str] = OrderedDict()
+		# the web UI reconstructs chunks from worker threads
+		self.lock = Lock()
+
+	def get_multi_texts(self, story_id: int, chapter_nos: Iterable[int]) -> dict[int, str]:
+		"""
+		Same as Chapter.get_multi_texts, which is only asked for the chapters that are not cached
+		"""
+		found = {}
+		missing = []
+		with self.lock:
+			for chapter in set(chapter_nos):
+				text = self.texts.get((story_id, chapter))
+				if text is None:
+					missing.append(chapter)
+				else:
+					self.texts.move_to_end((story_id, chapter))
+					found[chapter] = text
+		if not missing:
+			return found
+		fetched = Chapter.get_multi_texts(story_id, missing)
+		found.update(fetched)
+		with self.lock:
+			for chapter, text in fetched.items():
+				if (story_id, chapter) not in self.texts:
+					self.texts[(story_id, chapter)] = text
+					self.size += getsizeof(text)
+			while self.size > self.max_bytes and self.texts:
+				_, text = self.texts.popitem(last=False)
+				self.size -= getsizeof(text)
+		return found
+
+# shared by every Chunk.reconstruct_chunks call
+CHAPTER_TEXTS = ChapterTextCache()
+
+# overlays for the index templates, selected with index-fics.py --index-profile
+# "fields" are dotted paths into the mapping of the index and are merged into the field's mapping
+# chapter.text stays in _source and keeps its positions: get_multi_texts and the semantic search read it back,
+# and Kibana users phrase search it. synthetic _source would rebuild it, but needs stored text and a paid license
+INDEX_PROFILES = {
+	"fast": {},
+	"compact": {
+		"chapters": {
+			"settings": {"codec": "best_compression"}, # slows ingest down by ~1/5, reduces index size by ~1/3
+			"fields": {
+				"chapter.ghost": {"index_options": "docs", "norms": False},
+				"story.author.name": {"norms": False},
+				"story.groups.names": {"index_options": "freqs", "norms": False},
+				"story.folders.names": {"index_options": "freqs", "norms": False},
+			},
+		},
+		"stories": {
+			"settings": {"codec": "best_compression"},
+			"fields": {
+				"author.name": {"norms": False},
+				"groups.names": {"index_options": "freqs", "norms": False},
+				"folders.names": {"index_options": "freqs", "norms": False},
+			},
+		},
+	},
+	# faster phrase/prefix searches and highlighting on chapter text, exact sorting and aggregation on names
+	"search": {
+		"chapters": {
+			"fields": {
+				"chapter.text": {
+					"index_phrases": True, # two word shingles, for match_phrase
+					"index_prefixes": {}, # edge ngrams of 2-5 chars, for prefix and match_phrase_prefix
+					"term_vector": "with_positions_offsets", # highlight without re-analyzing megabytes of text
+				},
+				"chapter.title": {"fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+				"story.title": {"fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+				"story.author.name": {"fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+			},
+		},
+		"stories": {
+			"fields": {
+				"title": {"fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+				"author.name": {"fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+			},
+		},
+	},
+}
+
+
+def apply_index_profile(template: dict, index_prefix: str, profile: str) -> dict:
+	"""
+	Merge an index profile into a template generated by Document._index.as_template(...).to_dict()
+	:param template: the template, modified in place
+	:param index_prefix: e.g. "chapters" for chapters-*
+	:param profile: key of INDEX_PROFILES
+	:return: the template
+	"""
+	overlay = INDEX_PROFILES[profile].get(index_prefix, {})
+	template["settings"].update(overlay.get("settings", {}))
+	for field_path, field_options in overlay.get("fields", {}).items():
+		field_mapping = template["mappings"]
+		for field_name in field_path.split("."):
+			field_mapping = field_mapping["properties"][field_name]
+		field_mapping.update(field_options)
+	return template
+
+
+# painless for _reindex, strips full layout chapters down to the lean layout, see Chapter.leaned
+LEAN_LAYOUT_SCRIPT = f"""
+def story = ctx._source.story;
+def lean = [:];
+for (field in {list(Chapter.lean_story_fields)}) {{
+	if (story.containsKey(field)) {{
+		lean[field] = story[field];
+	}}
+}}
+if (story.containsKey('author')) {{
+	lean['author'] = ['id': story.author.id];
+}}
+ctx._source.story = lean;
+"""
+
+
 class DocStoryDescription(es_dsl_types.InnerDoc):
 	short = es_dsl_types.Text(meta={"source": "short_description"})
 	long = es_dsl_types.Text(meta={"source": "description_html"})
@@ -250,14 +411,17 @@ class Story(es_dsl_types.Document):
 			"query": {"default_field": "title"},
 		}
 
+	# fields shared with Chapter.story
+	story_fields = ("author", "words", "completion_status",
+						"content_rating", "score", "tags", "title",
+						"published", "views", "id", "groups", "folders")
+
 	def analyze(self, source: Chapter, story_meta: dict, archive_date: datetime):
-		direct_copies = ["author", "words", "completion_status",
-							"content_rating", "score", "tags", "title",
-							"published", "views", "id", "groups", "folders"]
-		for attr in direct_copies:
+		for attr in self.story_fields:
 			setattr(self, attr, getattr(source.story, attr))
 
 		if story_meta["description_html"]:
+			from bs4 import BeautifulSoup
 			desc_dom = BeautifulSoup(story_meta["description_html"], "html.parser") # likely consist of a single <p>
 			self.description.long = desc_dom.text
 		self.description.short = story_meta["short_description"]
@@ -298,6 +462,24 @@ class Story(es_dsl_types.Document):
 		except AttributeError:
 			raise ValueError(f"Story ID {story_id} does not have deletion flag?")
 
+	@classmethod
+	def lookup(cls, story_ids: Iterable[int], batch_size: int = 10000) -> dict[int, "Story"]:
+		"""
+		The newest copy of each story, which may be in several daily stories-* indices
+		:param batch_size: story IDs per search, at most index.max_result_window
+		"""
+		stories = {}
+		for batch in batched(dict.fromkeys(story_ids), batch_size):
+			story_search = cls.search()
+			story_search = story_search.filter(Q("terms", id=list(batch)))
+			story_search = story_search.sort({"_index": "desc"})
+			story_search = story_search.extra(source=list(cls.story_fields), size=len(batch), collapse={"field": "id"})
+			stories.update(
+				(story.id, story)
+				for story in story_search.execute()
+			)
+		return stories
+
 	@classmethod
 	def get_title_lite(cls, story_id: int) -> str:
 		story_search = cls.search()
@@ -312,6 +494,113 @@ class Story(es_dsl_types.Document):
 
 
 
+class DocRollupScore(es_dsl_types.InnerDoc):
+	wilson99_min = es_dsl_types.Float(meta={"source": "story.score.wilson99"})
+	wilson99_avg = es_dsl_types.Float(meta={"source": "story.score.wilson99"})
+	wilson99_max = es_dsl_types.Float(meta={"source": "story.score.wilson99"})
+	deciles = es_dsl_types.Integer(multi=True, meta={"source": "stories per tenth of story.score.wilson99"})
+	unrated = es_dsl_types.Integer(meta={"source": "stories without votes"})
+
+
+class AuthorRollup(es_dsl_types.Document):
+	author = es_dsl_types.Object(DocStoryAuthor)
+	stories = es_dsl_types.Integer(meta={"source": "stories"})
+	words = es_dsl_types.Long(meta={"source": "story.words"})
+	views = es_dsl_types.Long(meta={"source": "story.views"})
+	wilson99_words = es_dsl_types.Double(meta={"source": "story.words * story.score.wilson99"})
+	score = es_dsl_types.Object(DocRollupScore)
+	first_published = es_dsl_types.Date(meta={"source": "story.published"})
+	last_published = es_dsl_types.Date(meta={"source": "story.published"})
+
+	class Index:
+		name = "authors-*"
+		settings = {
+			"number_of_replicas": 0,
+			"query": {"default_field": "author.name"},
+		}
+
+
+class TagRollup(es_dsl_types.Document):
+	tags = es_dsl_types.Keyword(multi=True, meta={"source": "story.tags, one tag or a co-occurring pair"})
+	pair = es_dsl_types.Boolean(meta={"source": "len(tags) == 2"})
+	year = es_dsl_types.Date(meta={"source": "story.published, January 1st"})
+	stories = es_dsl_types.Integer(meta={"source": "stories"})
+	words = es_dsl_types.Long(meta={"source": "story.words"})
+	views = es_dsl_types.Long(meta={"source": "story.views"})
+	wilson99_avg = es_dsl_types.Float(meta={"source": "story.score.wilson99"})
+
+	class Index:
+		name = "tags-*"
+		settings = {
+			"number_of_replicas": 0,
+		}
+
+
+class Duplicate(es_dsl_types.Document):
+	level = es_dsl_types.Keyword(meta={"source": "story or chapter"})
+	stories = es_dsl_types.Integer(multi=True, meta={"source": "story.id of both"})
+	chapters = es_dsl_types.Integer(multi=True, meta={"source": "chapter.id of both, for the chapter level"})
+	similarity = es_dsl_types.Float(meta={"source": "MinHash estimate of the Jaccard similarity of word shingles"})
+
+	class Index:
+		name = "duplicates-*"
+		settings = {
+			"number_of_replicas": 0,
+		}
+
+
+class DocPassageStory(es_dsl_types.InnerDoc):
+	id = es_dsl_types.Integer(meta={"source": "id"})
+
+
+class DocPassageChapter(es_dsl_types.InnerDoc):
+	number = es_dsl_types.Short(meta={"source": "chapters.chapter_number or epub"})
+	id = es_dsl_types.Integer(meta={"source": "chapters.id"})
+	start = es_dsl_types.Integer(meta={"source": "offset into chapter.text"})
+	end = es_dsl_types.Integer(meta={"source": "offset into chapter.text"})
+
+
+class Passage(es_dsl_types.Document):
+	story = es_dsl_types.Object(DocPassageStory)
+	chapter = es_dsl_types.Object(DocPassageChapter)
+	text = es_dsl_types.Text(meta={"source": "epub"})
+
+	class Index:
+		name = "passages-*"
+		settings = {
+			"number_of_replicas": 0,
+			"query": {"default_field": "text"},
+		}
+
+	@classmethod
+	def from_chapter(cls, source: Chapter, size: int = 2000, overlap: int = 200) -> Iterable["Passage"]:
+		"""
+		Cut a chapter's text into windows of about size characters, each overlapping the previous one.
+		Windows end on whitespace where possible, and text == source.chapter.text[start:end]
+		"""
+		text = source.chapter.text or ""
+		start = 0
+		while start < len(text):
+			end = min(start + size, len(text))
+			if end < len(text):
+				word_end = text.rfind(" ", start + size // 2, end)
+				if word_end > start:
+					end = word_end
+			passage = cls()
+			passage.story.id = source.story.id
+			passage.chapter.id = source.chapter.id
+			passage.chapter.number = source.chapter.number
+			passage.chapter.start = start
+			passage.chapter.end = end
+			passage.text = text[start:end]
+			yield passage
+			if end >= len(text):
+				return
+			next_start = max(end - overlap, start + 1)
+			word_start = text.find(" ", next_start, end)
+			start = word_start + 1 if word_start >= 0 else next_start
+
+
 class DocChunkStory(es_dsl_types.InnerDoc):
 	id = es_dsl_types.Integer(meta={"source": "id"})
 
@@ -323,11 +612,35 @@ class DocChunkChapter(es_dsl_types.InnerDoc):
 	end = es_dsl_types.Integer(meta={"source": "epub"}, multi=True)
 
 
+# index_options of Chunk.embeddings, selected with "vector index" in vaguesearch.toml, see vector_bench.py
+# a float is 4 bytes per dimension, int8 is 1 and bbq is 1 bit (the int8/bbq types keep the floats on disk for rescoring)
+# flat types score every chunk of the story, hnsw types build a graph, which is faster on large stories
+VECTOR_INDEX_OPTIONS = {
+	"flat": {"type": "flat"},
+	"int8_flat": {"type": "int8_flat"},
+	"int8_hnsw": {"type": "int8_hnsw"},
+	"bbq_flat": {"type": "bbq_flat"},
+	"bbq_hnsw": {"type": "bbq_hnsw"},
+}
+
+
+def apply_vector_index(template: dict, option: str) -> dict:
+	"""
+	Set the index_options of the embeddings in a template of Chunk
+	:param template: the template, modified in place
+	:param option: key of VECTOR_INDEX_OPTIONS
+	:return: the template
+	"""
+	template["mappings"]["properties"]["embeddings"]["index_options"] = dict(VECTOR_INDEX_OPTIONS[option])
+	return template
+
+
 class Chunk(es_dsl_types.Document):
 	story = es_dsl_types.Object(DocChunkStory)
 	chapter = es_dsl_types.Object(DocChunkChapter)
 	embeddings = es_dsl_types.DenseVector(dims=1024, index_options={"type": "flat"})
 	order = es_dsl_types.Integer()
+	total = es_dsl_types.Integer()
 
 	class Index:
 		name = "chunks-*"
@@ -336,22 +649,34 @@ class Chunk(es_dsl_types.Document):
 		}
 
 	@staticmethod
-	def reconstruct_chunks(chunks: Iterable["Chunk"], context: bool = False) -> Iterable["Chunk"]:
-		story_id = chunks[0].story.id
-		chapter2get = set()
+	def reconstruct_chunks(chunks: Iterable["Chunk"], context: bool = False,
+						   cache: ChapterTextCache = CHAPTER_TEXTS) -> Iterable["Chunk"]:
+		"""
+		Slice the text, position and link of each chunk out of its chapters, which come from the cache when they can
+		"""
+		chapter2get: dict[int, set[int]] = {}
 		for chunk in chunks:
-			chapter2get.update(chunk.chapter.number)
-		chapter_texts = Chapter.get_multi_texts(story_id, chapter2get)
+			chapter2get.setdefault(chunk.story.id, set()).update(chunk.chapter.number)
+		# once per story, not per chunk
+		chapter_texts = {
+			story_id: cache.get_multi_texts(story_id, chapters)
+			for story_id, chapters in chapter2get.items()
+		}
+		deleted = {
+			story_id: Story.is_deleted(story_id)
+			for story_id in chapter2get
+		}
 
 		for chunk in chunks:
+			story_id = chunk.story.id
 			segment = ""
 			for i, chapter in enumerate(chunk.chapter.number):
 				slice_start = chunk.chapter.start[i]
 				slice_end = chunk.chapter.end[i]
-				segment += chapter_texts[chapter][slice_start:slice_end]
+				segment += chapter_texts[story_id][chapter][slice_start:slice_end]
 				if not hasattr(chunk, "pcent"):
-					chunk.pcent = slice_start / len(chapter_texts[chapter])
-			if Story.is_deleted(story_id):
+					chunk.pcent = slice_start / len(chapter_texts[story_id][chapter])
+			if deleted[story_id]:
 				chunk.link = f"https://fimfetch.net/story/{story_id}/a/{chunk.chapter.number[0]}"
 			else:
 				chunk.link = f"https://www.fimfiction.net/story/{story_id}/{chunk.chapter.number[0]}/a/"
@@ -359,12 +684,26 @@ class Chunk(es_dsl_types.Document):
 		return chunks
 
 	@classmethod
-	def is_embedded(cls, story_id: int) -> bool:
+	def embedding_progress(cls, story_id: int) -> tuple[int, Union[int, None], Union[str, None]]:
+		"""
+		:return: how many chunks of the story are stored, how many it was chunked into (None for chunks stored before
+		Chunk.total existed) and the index they are in
+		"""
 		story_search = cls.search()
 		story_search = story_search.filter(Q("term", story__id=story_id))
-		story_search = story_search.extra(size=1)
+		story_search = story_search.source(["total"])
+		story_search = story_search.extra(size=1, track_total_hits=True)
 		story_results = story_search.execute()
-		return story_results.hits.total.value > 0
+		if not story_results.hits:
+			return 0, None, None
+		first = story_results.hits[0]
+		return story_results.hits.total.value, getattr(first, "total", None), first.meta.index
+
+	@classmethod
+	def is_embedded(cls, story_id: int) -> bool:
+		stored, total, _ = cls.embedding_progress(story_id)
+		# chunks stored before Chunk.total existed can't tell, so they are taken as complete
+		return stored > 0 and (total is None or stored >= total)
 
 	def as_blob(self, human: bool = False) -> str:
 		included = hasattr(self, "to_chat")
@@ -379,8 +718,11 @@ class Chunk(es_dsl_types.Document):
 		return blob
 
 	@classmethod
-	def find_related(cls, story_id: int, vector: list[int]) -> Iterable["Chunk"]:
-		search = cls.search()
+	def find_related(cls, story_id: int, vector: list[int], index: str = None) -> Iterable["Chunk"]:
+		"""
+		:param index: search these indices instead of chunks-*
+		"""
+		search = cls.search(index=index)
 		story_filter = Q("term", story__id=story_id)
 		chunk_count_q = search.filter(story_filter)
 		chunk_count = chunk_count_q.execute().hits.total.value
@@ -1,5 +1,5 @@
-from argparse import ArgumentParser
-from pathlib import PosixPath
+from configargparse import ArgParser
+from pathlib import PosixPath, PurePosixPath
 from csv import DictReader
 from datetime import datetime, UTC
 from html import unescape
@@ -8,9 +8,20 @@ from pony import orm
 from tqdm import tqdm
 from pickle import loads, dumps, HIGHEST_PROTOCOL
 from sqlite3 import connect
+from hashlib import blake2b
+from io import StringIO
+from tarfile import open as tar_open
+from zipfile import ZipFile, is_zipfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from functools import cache, partial
+from itertools import groupby, batched
+from collections.abc import Iterable, Iterator
+from operator import itemgetter
+
+from grouplookup import GroupInfo, export_lookup
 
 db = orm.Database()
-GroupInfo = namedtuple("GroupInfo", ["story_id", "group_names", "group_ids", "folder_ids", "paths"])
 
 
 class KV(db.Entity):
@@ -60,12 +71,139 @@ class Placement(db.Entity):
 	folder = orm.Required(Folder, index=True)
 
 
+# one row per story, denormalized from Placement and the folder tree by GroupMeta.build_story_groups
+class StoryGroups(db.Entity):
+	_table_ = "story_groups"
+	story = orm.PrimaryKey(int, auto=False)
+	group_ids = orm.Optional(orm.IntArray)
+	group_names = orm.Optional(orm.StrArray)
+	folder_ids = orm.Optional(orm.IntArray)
+	paths = orm.Optional(orm.StrArray)
+
+
+# what GroupMeta.push last sent to Elasticsearch for each story
+class PushedGroups(db.Entity):
+	_table_ = "pushed_groups"
+	story = orm.PrimaryKey(int, auto=False)
+	digest = orm.Required(str)
+
+
+# what each file of the groups archive was when it was imported, so that GroupMeta.refresh can skip the unchanged ones
+class SourceFile(db.Entity):
+	path = orm.PrimaryKey(str)
+	mtime = orm.Required(float)
+	digest = orm.Required(str)
+
+
+GroupsMember = namedtuple("GroupsMember", ["path", "mtime", "read"])
+# every other file in the archive lists the stories of the folder it is named after
+STRUCTURE_FILES = (".scraped", "group-names", ".folders", ".names")
+# at the top of the archive, every other file is in a directory of its group
+TOP_FILES = (".scraped", "group-names")
+
+
+# sets the groups and folders of stories-* documents, or the story of full layout chapters-* documents
+PUSH_GROUPS_SCRIPT = """
+def target = params.chapters ? ctx._source.story : ctx._source;
+def info = params.stories[String.valueOf(target.id)];
+if (info == null) {
+	ctx.op = 'noop';
+} else {
+	target.groups = ['ids': info.group_ids, 'names': info.group_names];
+	target.folders = ['ids': info.folder_ids, 'names': info.paths];
+}
+"""
+
+
+def groups_digest(info: GroupInfo) -> str:
+	canonical = dumps([sorted(info.group_ids), sorted(info.group_names), sorted(info.folder_ids), sorted(info.paths)],
+					  HIGHEST_PROTOCOL)
+	return blake2b(canonical, digest_size=16).hexdigest()
+
+
+def pony_timestamp(moment: datetime) -> str:
+	# how PonyORM stores a datetime in SQLite, so that rows written with sqlite3 read back the same
+	timestamp = moment.isoformat(" ")
+	if len(timestamp) == 19:
+		timestamp += ".000000"
+	return timestamp
+
+
+def parse_groups_data(name: str, data: bytes, mtime: float) -> tuple[str, list, str]:
+	"""
+	Parse one file of the groups archive
+	:return: the kind of file, its rows as the read_* methods below would store them, and a digest of its content
+	"""
+	digest = blake2b(data, digest_size=16).hexdigest()
+	text = data.decode()
+	match name:
+		case ".scraped":
+			return "scraped", [], digest
+		case "group-names":
+			# groupid "group name"
+			reader = DictReader(StringIO(text, newline=""), ["group", "name"], delimiter=" ")
+			return "groups", [(int(row["group"]), unescape(row["name"])) for row in reader], digest
+		case ".folders":
+			# groupid folderid parentid
+			reader = DictReader(StringIO(text, newline=""), ["group", "folder", "parent"], delimiter=" ")
+			return "folders", [(int(row["group"]), int(row["folder"]), int(row["parent"])) for row in reader], digest
+		case ".names":
+			# folderid "foldername"
+			reader = DictReader(StringIO(text, newline=""), ["folder", "name"], delimiter=" ")
+			return "names", [(int(row["folder"]), unescape(row["name"])) for row in reader], digest
+		case _:
+			last_checked = datetime.fromtimestamp(mtime, UTC)
+			stories = [int(story_id) for story_id in text.splitlines()]
+			return "stories", [(int(name), pony_timestamp(last_checked), stories)], digest
+
+
+def parse_groups_member(member: tuple[str, float, bytes]) -> tuple[str, list, str]:
+	# runs in a worker process of GroupMeta.import_files
+	path, mtime, data = member
+	return parse_groups_data(PosixPath(path).name, data, mtime)
+
+
+def archive_path(path: str) -> str:
+	"""
+	The path of a file from the root of the groups archive, whatever the archive's top directory is called and
+	whether it was extracted or not, so that SourceFile knows the file by the same path from any of them
+	"""
+	parts = PurePosixPath(path).parts
+	return "/".join(parts[-1:] if parts[-1] in TOP_FILES else parts[-2:])
+
+
+def groups_members(source: PosixPath) -> Iterator[GroupsMember]:
+	"""
+	The files of the groups archive, either extracted to a directory or read straight from the archive (tar.gz,
+	tar.xz or zip) in a single sequential pass. Call read() before moving on to the next member, since a compressed
+	tar can't seek back to it.
+	"""
+	if source.is_dir():
+		for dirpath, _, files in source.walk():
+			for file in files:
+				path = dirpath / file
+				yield GroupsMember(archive_path(str(path.relative_to(source))), path.stat().st_mtime, path.read_bytes)
+	elif is_zipfile(source):
+		with ZipFile(source) as archive:
+			for info in archive.infolist():
+				if not info.is_dir():
+					# zip stores local time
+					mtime = datetime(*info.date_time).timestamp()
+					yield GroupsMember(archive_path(info.filename), mtime, partial(archive.read, info))
+	else:
+		with tar_open(source, "r|*") as archive:
+			for info in archive:
+				if info.isfile():
+					yield GroupsMember(archive_path(info.name), float(info.mtime), archive.extractfile(info).read)
+
+
 class GroupMeta:
 	def __init__(self, filename: PosixPath = PosixPath("folders.sqlite")):
 		file_path = str(filename)
 		db.bind(provider="sqlite", filename=file_path, create_db=True)
 		db.generate_mapping(create_tables=True)
 		with orm.db_session:
+			self.materialized = KV.contains("story groups") and KV.get("story groups")
 			if KV.contains("ready"):
 				self.ready = KV.get("ready")
 				return
@@ -83,27 +221,174 @@ class GroupMeta:
 	@classmethod
 	@orm.db_session
 	def scan_directory(cls, groups_dir: PosixPath):
-		print("Checking groups directory...")
-		file_total = 0
-		for _, _, files in groups_dir.walk():
-			file_total += len(files)
+		print("Reading groups archive...")
+		progress = tqdm(desc="Reading groups", unit="file")
+		for member in groups_members(groups_dir):
+			name = PosixPath(member.path).name
+			match name:
+				case ".scraped":
+					pass
+				case "group-names":
+					cls.read_groups(member.read().decode())
+				case ".folders":
+					cls.read_folders(member.read().decode())
+				case ".names":
+					cls.read_names(member.read().decode())
+				case _:
+					cls.read_stories(name, member.read().decode(), member.mtime)
+			progress.update()
+		progress.close()
 
-		progress = tqdm(desc="Reading groups", unit="file", total=file_total)
-		for dirpath, _, files in groups_dir.walk():
-			for file in files:
-				match file:
-					case ".scraped":
-						pass
-					case "group-names":
-						cls.read_groups(dirpath / file)
-					case ".folders":
-						cls.read_folders(dirpath / file)
-					case ".names":
-						cls.read_names(dirpath / file)
-					case _:
-						cls.read_stories(dirpath / file)
-				progress.update()
+	def bulk_import(self, groups_dir: PosixPath, workers: int = None):
+		"""
+		The fast equivalent of scan_directory for an empty database
+		"""
+		print("Reading groups archive...")
+		self.import_files(groups_members(groups_dir), True, workers)
+
+	def import_files(self, members: Iterable[GroupsMember], fresh: bool, workers: int = None,
+					 batch_size: int = 100000) -> tuple[dict[int, str], dict[int, list]]:
+		"""
+		Parse files of the groups archive in a process pool and write the rows with sqlite3 executemany in batched
+		transactions. The members are read in order, a few thousand at a time are handed to the pool.
+		:param fresh: the database is empty, so the Placement indexes are dropped while loading and built last
+		:return: the groups and the folders (name, group, parent, last checked) listed in the files
+		"""
+		groups: dict[int, str] = {}
+		folders: dict[int, list] = {}
+		placements = []
+		placement_total = 0
+		recorded = {}
+		start = perf_counter()
+
+		con = connect(db.provider.pool.filename)
+		con.execute("pragma journal_mode=wal")
+		con.execute("pragma synchronous=off")
+		if fresh:
+			con.execute('drop index if exists "idx_placement__folder"')
+			con.execute('drop index if exists "idx_placement__story"')
+			con.execute('delete from "Placement"')
+		else:
+			recorded = dict(con.execute('select "path", "digest" from "SourceFile"'))
+		con.commit()
+
+		def flush_placements():
+			con.executemany('insert into "Placement" ("story", "folder") values (?, ?)', placements)
+			con.commit()
+			placements.clear()
+
+		progress = tqdm(desc="Reading groups", unit="file")
+		loaded = ((member.path, member.mtime, member.read()) for member in members)
+		with ProcessPoolExecutor(workers) as pool:
+			for batch in batched(loaded, 4096):
+				parsed = pool.map(parse_groups_member, batch, chunksize=256)
+				for (source_path, mtime, _), (kind, rows, digest) in zip(batch, parsed):
+					unchanged = recorded.get(source_path) == digest
+					match kind:
+						case "groups":
+							groups.update(rows)
+						case "folders":
+							for group_id, folder_id, parent in rows:
+								groups.setdefault(group_id, "")
+								folder = folders.setdefault(folder_id, ["", None, None, None])
+								folder[1] = group_id
+								if parent:
+									folder[2] = parent
+						case "names":
+							for folder_id, name in rows:
+								folders.setdefault(folder_id, ["", None, None, None])[0] = name
+						case "stories":
+							for folder_id, last_checked, stories in rows:
+								folders.setdefault(folder_id, ["", None, None, None])[3] = last_checked
+								# a new mtime with the same content only means that the folder was checked again
+								if unchanged:
+									continue
+								if not fresh:
+									con.execute('delete from "Placement" where "folder" = ?', (folder_id, ))
+								placements.extend((story_id, folder_id) for story_id in stories)
+								placement_total += len(stories)
+					con.execute('insert or replace into "SourceFile" ("path", "mtime", "digest") values (?, ?, ?)',
+								(source_path, mtime, digest))
+					if len(placements) >= batch_size:
+						flush_placements()
+					progress.update()
 		progress.close()
+		flush_placements()
+
+		# the stub group and folder made by __init__ are kept
+		con.executemany('insert into "Group" ("id", "name", "exists") values (?, ?, 1) '
+						'on conflict ("id") do update set "name" = excluded."name"', groups.items())
+		# folders whose story file was not read keep their last checked
+		con.executemany('insert into "Folder" ("id", "name", "group", "parent", "last_checked", "exists") '
+						'values (?, ?, ?, ?, ?, 1) on conflict ("id") do update set "name" = excluded."name", '
+						'"group" = excluded."group", "parent" = excluded."parent", '
+						'"last_checked" = coalesce(excluded."last_checked", "Folder"."last_checked")',
+						[(folder_id, *folder) for folder_id, folder in folders.items()])
+		con.commit()
+		if fresh:
+			print("Indexing placements...")
+			con.execute('create index "idx_placement__folder" on "Placement" ("folder")')
+			con.execute('create index "idx_placement__story" on "Placement" ("story")')
+			con.commit()
+		# WAL is only for the load, back to a lone folders.sqlite without -wal/-shm files next to it
+		con.execute("pragma journal_mode=delete")
+		con.close()
+		elapsed = perf_counter() - start
+		rows = placement_total + len(groups) + len(folders)
+		print(f"Imported {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)")
+		return groups, folders
+
+	def refresh(self, groups_dir: PosixPath, workers: int = None):
+		"""
+		Update the database from a newer groups archive: only the folder files whose mtime changed are read, and only
+		those whose content changed are re-imported. Groups and folders which are no longer listed are marked as not
+		existing, and the last checked times and story_groups are worked out again.
+		"""
+		print("Reading groups archive...")
+		con = connect(db.provider.pool.filename)
+		recorded = dict(con.execute('select "path", "mtime" from "SourceFile"'))
+		con.close()
+		current = {}
+
+		def changed_members():
+			# the group and folder lists are small, and they are needed whole to tell what vanished
+			for member in groups_members(groups_dir):
+				name = PosixPath(member.path).name
+				current[member.path] = name
+				if name in STRUCTURE_FILES or recorded.get(member.path) != member.mtime:
+					yield member
+
+		groups, folders = self.import_files(changed_members(), False, workers)
+		vanished = recorded.keys() - current.keys()
+		print(f"{len(current)} files in the archive, {len(vanished)} vanished")
+
+		con = connect(db.provider.pool.filename)
+		current_folders = {int(name) for name in current.values() if name not in STRUCTURE_FILES}
+		for source_path in vanished:
+			name = PosixPath(source_path).name
+			# a folder file which is still in the archive under another path was imported again from there
+			if name not in STRUCTURE_FILES and int(name) not in current_folders:
+				con.execute('delete from "Placement" where "folder" = ?', (int(name), ))
+			con.execute('delete from "SourceFile" where "path" = ?', (source_path, ))
+		listed_folders = folders.keys() | current_folders
+		for table, listed in (("Group", groups.keys()), ("Folder", listed_folders)):
+			existing = {row_id: bool(exists) for row_id, exists in con.execute(f'select "id", "exists" from "{table}"')}
+			updates = [(row_id in listed, row_id) for row_id, exists in existing.items()
+					   if row_id and exists != (row_id in listed)]
+			con.executemany(f'update "{table}" set "exists" = ? where "id" = ?', updates)
+			print(f"{table}: {sum(not exists for exists, _ in updates)} vanished, {sum(exists for exists, _ in updates)} returned")
+		con.commit()
+		con.close()
+		self.update_last_checked()
+		self.build_story_groups()
+
+	def placements_digest(self) -> str:
+		con = connect(db.provider.pool.filename)
+		hasher = blake2b(digest_size=16)
+		for row in con.execute('select "folder", "story" from "Placement" order by "folder", "story"'):
+			hasher.update(repr(row).encode())
+		con.close()
+		return hasher.hexdigest()
 
 	@orm.db_session
 	def update_last_checked(self):
@@ -111,8 +396,15 @@ class GroupMeta:
 		most_recent = datetime.fromtimestamp(0, UTC)
 		for group in tqdm(Group.select(lambda g: g.id and not g.folders.is_empty()),
 							"Calculating", unit="g", bar_format="{l_bar}{bar}"):
-			last_checked_str = max(f.last_checked for f in group.folders)
-			group.last_checked = datetime.fromisoformat(last_checked_str)
+			last_checked = max((f.last_checked for f in group.folders if f.last_checked), default=None)
+			if last_checked is None:
+				continue
+			# depending on the PonyORM version, it comes back as the stored string or as a naive datetime
+			if isinstance(last_checked, str):
+				last_checked = datetime.fromisoformat(last_checked)
+			if last_checked.tzinfo is None:
+				last_checked = last_checked.replace(tzinfo=UTC)
+			group.last_checked = last_checked
 			if group.last_checked > most_recent:
 				most_recent = group.last_checked
 		KV.set("last checked", most_recent)
@@ -121,18 +413,66 @@ class GroupMeta:
 		last_checked_local = most_recent.astimezone().isoformat(timespec="minutes")
 		print(f"Last checked: {last_checked_local}")
 
-	def scan_all(self, groups_dir: PosixPath):
+	def scan_all(self, groups_dir: PosixPath, workers: int = None):
 		# split into separate DB sessions because the first modifies the fields that the latter reads
-		self.scan_directory(groups_dir)
+		self.bulk_import(groups_dir, workers)
 		# it can also be fixed by setting volatile=true on Folder.last_checked
 		self.update_last_checked()
+		self.build_story_groups()
 		# has to be run outside a transaction, but PonyORM does not allow anything except select
 		KV._database_.provider.pool.con.execute("vacuum")
 
+	@orm.db_session
+	def build_story_groups(self):
+		"""
+		Materialize groups4story for every story into story_groups, so that lookups are a single read by primary key
+		"""
+		print("Building story groups...")
+		group_names = dict(db.select('select id, name from "Group"'))
+		folders = {folder_id: (name, parent, group) for folder_id, name, parent, group in
+				   db.select('select id, name, parent, "group" from Folder')}
+
+		@cache
+		def folder_closure(folder_id: int) -> tuple[int, tuple[tuple[int, str], ...]]:
+			# the same walk as tree(), but each folder is only walked once: the top of the tree decides the group,
+			# and an orphan gets the stub folder as its parent
+			name, parent, group = folders[folder_id]
+			path = ((folder_id, name), )
+			seen = {folder_id}
+			while parent and parent not in seen:
+				if parent not in folders:
+					return group, ((0, "stub"), *path)
+				seen.add(parent)
+				name, grandparent, group = folders[parent]
+				path = ((parent, name), *path)
+				parent = grandparent
+			return group, path
+
+		StoryGroups.select().delete(bulk=True)
+		placements = db.select("select story, folder from Placement order by story")
+		for story, story_placements in tqdm(groupby(placements, key=itemgetter(0)), "Materializing", unit="story"):
+			group_ids = set()
+			group_name_set = set()
+			folder_ids = set()
+			paths = []
+			for _, folder_id in story_placements:
+				group_id, path = folder_closure(folder_id)
+				group_name = group_names.get(group_id)
+				if group_name:
+					paths.append(f"{group_name}/" + "/".join([name or "" for _, name in path]))
+					group_name_set.add(group_name)
+				if group_id is not None:
+					group_ids.add(group_id)
+				folder_ids |= {path_id for path_id, _ in path if path_id}
+			StoryGroups(story=story, group_ids=sorted(group_ids), group_names=sorted(group_name_set),
+						folder_ids=sorted(folder_ids), paths=paths)
+		KV.set("story groups", True)
+		self.materialized = True
+
 	@staticmethod
-	def read_groups(group_list: PosixPath):
+	def read_groups(group_list: str):
 		# groupid "group name"
-		with group_list.open(newline="") as fh:
+		with StringIO(group_list, newline="") as fh:
 			reader = DictReader(fh, ["group", "name"], delimiter=" ")
 			for row in reader:
 				group_id = int(row["group"])
@@ -143,9 +483,9 @@ class GroupMeta:
 				group.name = unescape(row["name"])
 
 	@staticmethod
-	def read_folders(folder_list: PosixPath):
+	def read_folders(folder_list: str):
 		# groupid folderid parentid
-		with folder_list.open(newline="") as fh:
+		with StringIO(folder_list, newline="") as fh:
 			reader = DictReader(fh, ["group", "folder", "parent"], delimiter=" ")
 			for row in reader:
 				group_id = int(row["group"])
@@ -164,9 +504,9 @@ class GroupMeta:
 					folder.parent = parent
 
 	@staticmethod
-	def read_names(folder_list: PosixPath):
+	def read_names(folder_list: str):
 		# folderid "foldername"
-		with folder_list.open(newline="") as fh:
+		with StringIO(folder_list, newline="") as fh:
 			reader = DictReader(fh, ["folder", "name"], delimiter=" ")
 			for row in reader:
 				folder_id = int(row["folder"])
@@ -177,11 +517,10 @@ class GroupMeta:
 					folder = Folder(id=folder_id, name=unescape(row["name"]))
 
 	@staticmethod
-	def read_stories(story_list: PosixPath):
-		text = story_list.read_text()
-		obj_id = int(story_list.name)
-		last_checked = datetime.fromtimestamp(story_list.stat().st_mtime, UTC)
-		stories = [int(story_id) for story_id in text.splitlines()]
+	def read_stories(name: str, story_list: str, mtime: float):
+		obj_id = int(name)
+		last_checked = datetime.fromtimestamp(mtime, UTC)
+		stories = [int(story_id) for story_id in story_list.splitlines()]
 		try:
 			obj = Folder[obj_id]
 			obj.last_checked = last_checked
@@ -193,12 +532,74 @@ class GroupMeta:
 		for story_id in stories:
 			Placement(folder=obj, story=story_id)
 
-	@staticmethod
-	def tree(folders: list[Folder]) -> list[Folder]:
+	def push(self, batch_size: int = 500, index_prefixes: tuple[str, ...] = ("stories", "chapters")):
+		"""
+		Update the groups and folders of the stories already in Elasticsearch with update_by_query, a batch of stories
+		at a time. Stories whose groups are the same as the last push are skipped, and stories which are no longer in
+		any group get empty groups. Chapters in the lean layout have no groups, so they are left alone.
+		"""
+		from elasticsearch.dsl import connections
+		conn = connections.get_connection()
+		con = connect(db.provider.pool.filename)
+		pushed = dict(con.execute('select "story", "digest" from "pushed_groups"'))
+		changed = []
+		seen = set()
+		for info in self.all_story_groups():
+			seen.add(info.story_id)
+			digest = groups_digest(info)
+			if pushed.get(info.story_id) != digest:
+				changed.append((info, digest))
+		for story_id in pushed.keys() - seen:
+			changed.append((GroupInfo(story_id, set(), set(), set(), []), None))
+		print(f"{len(changed)} of {len(seen)} stories changed since the last push")
+		if not changed:
+			con.close()
+			return
+
+		start = perf_counter()
+		updated = 0
+		progress = tqdm(desc="Pushing groups", unit="story", total=len(changed))
+		for batch in batched(changed, batch_size):
+			stories = {
+				str(info.story_id): {
+					"group_ids": sorted(info.group_ids),
+					"group_names": sorted(info.group_names),
+					"folder_ids": sorted(info.folder_ids),
+					"paths": sorted(info.paths),
+				}
+				for info, _ in batch
+			}
+			story_ids = [info.story_id for info, _ in batch]
+			for prefix in index_prefixes:
+				if prefix == "chapters":
+					# only the full layout has story.title
+					query = {"bool": {"filter": [{"terms": {"story.id": story_ids}}, {"exists": {"field": "story.title"}}]}}
+				else:
+					query = {"terms": {"id": story_ids}}
+				response = conn.update_by_query(index=f"{prefix}-*", query=query, conflicts="proceed",
+												script={"source": PUSH_GROUPS_SCRIPT, "lang": "painless",
+														"params": {"chapters": prefix == "chapters", "stories": stories}},
+												wait_for_completion=True, refresh=False)
+				updated += response["updated"]
+			con.executemany('insert or replace into "pushed_groups" ("story", "digest") values (?, ?)',
+							[(info.story_id, digest) for info, digest in batch if digest])
+			con.executemany('delete from "pushed_groups" where "story" = ?',
+							[(info.story_id, ) for info, digest in batch if not digest])
+			con.commit()
+			progress.update(len(batch))
+		progress.close()
+		con.close()
+		conn.indices.refresh(index=",".join(f"{prefix}-*" for prefix in index_prefixes))
+		elapsed = perf_counter() - start
+		print(f"Pushed {len(changed)} stories, {updated} documents updated in {elapsed:.1f}s "
+			  f"({len(changed) / max(elapsed, 1e-9):.0f} stories/s, {updated / max(elapsed, 1e-9):.0f} docs/s)")
+
+	@classmethod
+	def tree(cls, folders: list[Folder]) -> list[Folder]:
 		# recursively walk up a folder tree until the top is found
-		if folders[0].parent:
+		if folders[0].parent and folders[0].parent not in {folder.id for folder in folders}:
 			try:
-				return [Folder[folders[0].parent], *folders]
+				return cls.tree([Folder[folders[0].parent], *folders])
 			except orm.ObjectNotFound:
 				#this shouldn't  happen, but could in case of orphan folders on future updates to the database
 				stub_folder = Folder[0]
@@ -217,6 +618,11 @@ class GroupMeta:
 		"""
 		if not self.ready:
 			raise ValueError("The database has not been populated yet!")
+		if self.materialized and parents:
+			row = StoryGroups.get(story=story)
+			if row is None:
+				return GroupInfo(story, set(), set(), set(), [])
+			return GroupInfo(story, set(row.group_names), set(row.group_ids), set(row.folder_ids), list(row.paths))
 		# found = Folder.select(lambda a: story in a.stories)
 		# found = Placement.select(lambda m: m.story == story)
 		found = Placement.select(story=story)
@@ -242,6 +648,11 @@ class GroupMeta:
 	def all_story_groups(self, parents: bool = True):
 		if not self.ready:
 			raise ValueError("The database has not been populated yet!")
+		if self.materialized and parents:
+			# streamed in story order, like StoryFeed
+			for row in StoryGroups.select().order_by(StoryGroups.story):
+				yield GroupInfo(row.story, set(row.group_names), set(row.group_ids), set(row.folder_ids), list(row.paths))
+			return
 		#found = Placement.select(lambda p: p in Placement)
 		# obtuse ORM nonsense; this way is much, much, much faster
 		found = orm.select((p.story, ) for p in Placement) # it automatically does distinct
@@ -249,21 +660,76 @@ class GroupMeta:
 			yield self.groups4story(story, parents)
 
 
+def setup_elasticsearch(configuration):
+	from elasticsearch.dsl import connections
+	if configuration.api_id:
+		authentication = {
+			"api_key": (configuration.api_id, configuration.api_secret)
+		}
+	else:
+		authentication = {
+			"basic_auth": (configuration.username, configuration.password)
+		}
+	connections.create_connection(hosts=configuration.es_hosts,
+								  ca_certs=configuration.es_ca_cert_path,
+								  request_timeout=600, # a batch of update_by_query waits for completion
+								  **authentication)
+
+
 if __name__ == "__main__":
 	me = PosixPath(__file__)
 	db_path = me.with_name("folders.sqlite")
-	configuration = ArgumentParser("Import flat files group information from https://github.com/uis246/fimfarc-search/ to a database!")
-	configuration.add_argument("--db-path", help="path to output sqlite database", default=str(db_path))
-	configuration.add_argument("--folder-path", help="path to extracted groups archive", required=False)
+	configuration = ArgParser(description="Import flat files group information from https://github.com/uis246/fimfarc-search/ to a database!",
+							  default_config_files=[str(me.with_name("index-fics.ini"))],
+							  ignore_unknown_config_file_keys=True)
+	configuration.add_argument('-c', '--config', is_config_file=True, help='config file path')
+	configuration.add_argument("--db-path", "--folders-db", help="path to output sqlite database", default=str(db_path))
+	configuration.add_argument("--folder-path", help="path to the groups archive (tar.gz, tar.xz or zip) or the directory it was extracted to", required=False)
+	configuration.add_argument("--refresh", action="store_true",
+							   help="update an existing database from a newer groups archive at --folder-path")
+	configuration.add_argument("--check-refresh", action="store_true",
+							   help="with --refresh, refresh from the same archive again and fail if any placement changed")
+	configuration.add_argument("--workers", type=int, help="processes parsing the archive (default: one per CPU)")
+	configuration.add_argument("--export-lookup", help="also write a memory-mappable lookup file for index-fics.py --folders-lookup")
+	push_config = configuration.add_argument_group(title="Push changed groups to the existing indices (uses the Elasticsearch settings of index-fics.ini)")
+	push_config.add_argument("--push", action="store_true", help="update story.groups/story.folders in stories-* and chapters-*")
+	push_config.add_argument("--push-batch", type=int, default=500, help="stories per update_by_query")
+	push_config.add_argument("--api-id")
+	push_config.add_argument("--api-secret")
+	push_config.add_argument("--username")
+	push_config.add_argument("--password")
+	push_config.add_argument("--es-ca-cert-path")
+	push_config.add_argument("--es-hosts", action="append")
 	args = configuration.parse_args()
 	group_db = GroupMeta(args.db_path)
 	if not group_db.ready:
 		folder_path = PosixPath(args.folder_path)
 		assert folder_path.exists(), "You must specify a real folder path to populate the database!"
-		group_db.scan_all(folder_path)
-	from time import process_time
-	start = process_time()
-	for story_meta in group_db.all_story_groups():
-		continue
-	end = process_time()
-	print(f"Scanned all stories in {end - start} seconds")
+		group_db.scan_all(folder_path, args.workers)
+	elif args.refresh:
+		folder_path = PosixPath(args.folder_path)
+		assert folder_path.exists(), "You must specify a real folder path to refresh the database!"
+		group_db.refresh(folder_path, args.workers)
+		if args.check_refresh:
+			refreshed = group_db.placements_digest()
+			group_db.refresh(folder_path, args.workers)
+			if group_db.placements_digest() != refreshed:
+				raise SystemExit("Refreshing from the same archive changed the placements!")
+			print("Refreshing from the same archive left the placements unchanged")
+	elif not group_db.materialized:
+		# databases from before story_groups existed
+		group_db.build_story_groups()
+	if args.export_lookup:
+		exported = export_lookup(group_db.all_story_groups(), PosixPath(args.export_lookup))
+		print(f"Exported {exported} stories to {args.export_lookup}")
+	if args.push:
+		assert args.es_hosts, "You must configure es-hosts to push to Elasticsearch!"
+		setup_elasticsearch(args)
+		group_db.push(args.push_batch)
+	else:
+		from time import process_time
+		start = process_time()
+		for story_meta in group_db.all_story_groups():
+			continue
+		end = process_time()
+		print(f"Scanned all stories in {end - start} seconds")
@@ -0,0 +1,136 @@
+"""
+A read-only, memory-mapped copy of the story_groups table of folders.sqlite, for looking up the groups of stories
+from any number of threads or processes without PonyORM or SQL. Every process maps the same file, so the data is
+shared through the page cache.
+
+Layout, all little endian uint32 after the 16 byte header (magic, version, story count, string count):
+	story IDs, sorted
+	record offsets into the record array, one per story plus the end
+	string offsets into the string blob, one per string plus the end
+	records: group count, group IDs, group name count, group name strings, folder count, folder IDs, path count, path strings
+	string blob: the interned group names and folder paths in UTF-8
+"""
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Iterable
+from functools import lru_cache
+from mmap import mmap, ACCESS_READ
+from pathlib import Path
+from struct import pack, unpack_from
+from sys import byteorder
+
+GroupInfo = namedtuple("GroupInfo", ["story_id", "group_names", "group_ids", "folder_ids", "paths"])
+
+MAGIC = b"EFGL"
+VERSION = 1
+HEADER_SIZE = 16
+
+
+def little_endian(values: array) -> bytes:
+	if byteorder != "little":
+		values = array(values.typecode, values)
+		values.byteswap()
+	return values.tobytes()
+
+
+def export_lookup(story_groups: Iterable[GroupInfo], path: Path) -> int:
+	"""
+	Write a lookup file from GroupInfo tuples, e.g. GroupMeta.all_story_groups()
+	:return: the number of stories written
+	"""
+	story_ids = array("I")
+	record_offsets = array("I", [0])
+	records = array("I")
+	strings: dict[str, int] = {}
+
+	def intern(values: Iterable[str]) -> list[int]:
+		return [strings.setdefault(value, len(strings)) for value in values]
+
+	for info in sorted(story_groups, key=lambda info: info.story_id):
+		group_names = intern(sorted(info.group_names))
+		paths = intern(info.paths)
+		story_ids.append(info.story_id)
+		records.append(len(info.group_ids))
+		records.extend(sorted(info.group_ids))
+		records.append(len(group_names))
+		records.extend(group_names)
+		records.append(len(info.folder_ids))
+		records.extend(sorted(info.folder_ids))
+		records.append(len(paths))
+		records.extend(paths)
+		record_offsets.append(len(records))
+
+	blob = bytearray()
+	string_offsets = array("I", [0])
+	for value in strings: # insertion order is the interned index
+		blob += value.encode()
+		string_offsets.append(len(blob))
+
+	with Path(path).open("wb") as fh:
+		fh.write(MAGIC + pack("<III", VERSION, len(story_ids), len(strings)))
+		for section in (story_ids, record_offsets, string_offsets, records):
+			fh.write(little_endian(section))
+		fh.write(blob)
+	return len(story_ids)
+
+
+class GroupLookup:
+	"""
+	The reading side of export_lookup, with the same groups4story as folders.GroupMeta. Instances may be passed to
+	worker processes, which map the file again on their side.
+	"""
+	def __init__(self, path: Path):
+		if byteorder != "little":
+			raise ValueError("the groups lookup file is little endian, and it is read in place")
+		self.path = Path(path)
+		self.ready = True
+		with self.path.open("rb") as fh:
+			self.map = mmap(fh.fileno(), 0, access=ACCESS_READ)
+		magic, version, story_count, string_count = unpack_from("<4sIII", self.map)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(f"{self.path} is not a version {VERSION} groups lookup file")
+		view = memoryview(self.map)
+		position = HEADER_SIZE
+		sections = []
+		for length in (story_count, story_count + 1, string_count + 1):
+			sections.append(view[position:position + length * 4].cast("I"))
+			position += length * 4
+		self.story_ids, self.record_offsets, self.string_offsets = sections
+		record_count = self.record_offsets[-1]
+		self.records = view[position:position + record_count * 4].cast("I")
+		self.blob = view[position + record_count * 4:]
+		self.string = lru_cache(maxsize=65536)(self.decode_string)
+
+	def __getstate__(self) -> dict:
+		return {"path": self.path}
+
+	def __setstate__(self, state: dict):
+		self.__init__(state["path"])
+
+	def __len__(self) -> int:
+		return len(self.story_ids)
+
+	def decode_string(self, index: int) -> str:
+		return bytes(self.blob[self.string_offsets[index]:self.string_offsets[index + 1]]).decode()
+
+	def groups4story(self, story: int, parents: bool = True) -> GroupInfo:
+		"""
+		Same as GroupMeta.groups4story, the folder IDs always include the parent folders
+		"""
+		position = bisect_left(self.story_ids, story)
+		if position == len(self.story_ids) or self.story_ids[position] != story:
+			return GroupInfo(story, set(), set(), set(), [])
+		cursor = self.record_offsets[position]
+		fields = []
+		for _ in range(4):
+			count = self.records[cursor]
+			fields.append(self.records[cursor + 1:cursor + 1 + count])
+			cursor += 1 + count
+		group_ids, group_names, folder_ids, paths = fields
+		return GroupInfo(story, {self.string(name) for name in group_names}, set(group_ids), set(folder_ids),
+						 [self.string(path) for path in paths])
+
+	def all_story_groups(self, parents: bool = True):
+		for story in self.story_ids:
+			yield self.groups4story(story, parents)
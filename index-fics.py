@@ -7,28 +7,35 @@ from io import TextIOWrapper
 from threading import Thread, Event
 from queue import Queue, Empty, Full
 from signal import signal, SIGINT
-from datetime import datetime
+from datetime import datetime, UTC
+from time import sleep
 from pathlib import Path
-from math import inf
 from warnings import catch_warnings, simplefilter
 from dataclasses import dataclass
+from argparse import ArgumentTypeError
 
 from tqdm import tqdm
 from configargparse import ArgParser, FileType
 from elasticsearch.dsl import connections, Document
 from elasticsearch.helpers import streaming_bulk, BulkIndexError
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError
 from requests import Session
 
 from ebooklib.epub import EpubException, EpubReader
 from ebooklib import ITEM_DOCUMENT
 from collections.abc import Iterable
-from typing import Type, ClassVar, NamedTuple, Union
+from typing import Type, ClassVar, NamedTuple, Union, TYPE_CHECKING
 from configargparse import Namespace
 from re import Pattern
 
-from esdocs import Chapter, Story
-from folders import GroupMeta
+from esdocs import Chapter, Story, Passage, AuthorRollup, TagRollup, Duplicate, Chunk, INDEX_PROFILES, LEAN_LAYOUT_SCRIPT, apply_index_profile
+from esdocs import VECTOR_INDEX_OPTIONS, apply_vector_index
+from idsets import StoryIdSet
+
+# pony is only needed with folders-db
+if TYPE_CHECKING:
+	from folders import GroupMeta
+	from grouplookup import GroupLookup
 
 
 class StoryFeed:
@@ -69,7 +76,8 @@ class UnanalyzedStory:
 	story_meta: dict
 	epub_data: EpubReader
 	archive_date: datetime
-	group_db: Union[GroupMeta, bool]
+	group_db: Union["GroupMeta", "GroupLookup", bool]
+	lean: bool = False
 	whitespace_pattern: ClassVar[Pattern] = compile(r"[\s]+")
 	UnanalyzedChapter: ClassVar[NamedTuple] = namedtuple("UnanalyzedChapter", ["number", "title", "href"])
 
@@ -138,7 +146,8 @@ class UnanalyzedStory:
 		for chapter in chapter_map:
 			es_chapter = Chapter()
 			es_chapter.analyze(chapter, self.story_meta, self.chapters_data, groups_info)
-			yield es_chapter
+			# the story is analyzed from the last full chapter, don't yield that one
+			yield es_chapter.leaned() if self.lean else es_chapter
 		else:
 			es_story = Story()
 			es_story.analyze(es_chapter, self.story_meta, self.archive_date)
@@ -181,19 +190,56 @@ def process_fics(configuration, es_queue: Queue, stop_event: Event):
 	first_checked = datetime.fromtimestamp(0)
 	progress = tqdm(total=configuration.story_count, unit="story", smoothing=0.03)
 
+	ids_to_skip = StoryIdSet()
+	for skip_file in configuration.skip_ids:
+		ids_to_skip = ids_to_skip | StoryIdSet.from_file(skip_file)
 	if "Advisory" in configuration.skip_tags:
-		from advisory_skipper import generate_skips
-		skips_generator = generate_skips()
-		id_to_skip = next(skips_generator)
+		ids_to_skip = ids_to_skip | StoryIdSet.advisory()
 		configuration.skip_tags.remove("Advisory")
+	if configuration.only_ids:
+		ids_to_keep = StoryIdSet()
+		for keep_file in configuration.only_ids:
+			ids_to_keep = ids_to_keep | StoryIdSet.from_file(keep_file)
 	else:
-		id_to_skip = inf
+		ids_to_keep = None
 
-	if configuration.folders_db:
+	if configuration.folders_lookup:
+		from grouplookup import GroupLookup
+		group_db = GroupLookup(configuration.folders_lookup)
+	elif configuration.folders_db:
+		from folders import GroupMeta
 		group_db = GroupMeta(configuration.folders_db)
 	else:
 		group_db = False
 
+	if configuration.rollups:
+		from rollups import Rollups
+		rollups = Rollups()
+	else:
+		rollups = None
+
+	if configuration.dedupe:
+		from dedupe import NearDuplicates
+		duplicates = NearDuplicates(configuration.dedupe, configuration.dedupe_capacity, configuration.dedupe_threshold)
+	else:
+		duplicates = None
+
+	if configuration.embed_host:
+		from adapters import STAPIEmbeddings
+		cache = None
+		if configuration.embed_cache:
+			from embedcache import EmbeddingCache
+			cache = EmbeddingCache(configuration.embed_cache, configuration.embed_model or configuration.embed_host,
+								   configuration.embed_cache_megabytes)
+		embedder = STAPIEmbeddings(configuration.embed_host, cache)
+		ids_to_embed = None
+		if configuration.embed_ids:
+			ids_to_embed = StoryIdSet()
+			for embed_file in configuration.embed_ids:
+				ids_to_embed = ids_to_embed | StoryIdSet.from_file(embed_file)
+	else:
+		embedder = None
+
 	for story_meta in story_feed.stories():
 		if stop_event.is_set():
 			progress.close()
@@ -202,14 +248,12 @@ def process_fics(configuration, es_queue: Queue, stop_event: Event):
 		if not first_checked.tzinfo:
 			first_checked = datetime.fromisoformat(story_meta["archive"]["date_fetched"])
 
-		if story_meta["id"] == id_to_skip:
+		if story_meta["id"] in ids_to_skip:
+			progress.update()
+			continue
+		if ids_to_keep is not None and story_meta["id"] not in ids_to_keep:
 			progress.update()
 			continue
-		if story_meta["id"] >= id_to_skip:
-			try:
-				id_to_skip = next(skips_generator)
-			except StopIteration:
-				id_to_skip = inf
 
 		story_file = story_file_pattern.match(story_meta["archive"]["path"]).group("story_file") #file name sans .epub
 		story_file_short = f"{story_file[-story_file_max_length:]}" #the tail end of the filename, if it is long
@@ -222,7 +266,10 @@ def process_fics(configuration, es_queue: Queue, stop_event: Event):
 				simplefilter(action="ignore", category=FutureWarning) # ebooklib/epub.py:1423 xml root element warning
 				simplefilter(action="ignore", category=UserWarning) # ebooklib/epub.py:1395 useless warning about ignoring ncx
 				book = read_epub(story_epub, {"ignore_ncx": False})
-		story = UnanalyzedStory(story_meta, book, first_checked, group_db)
+		story = UnanalyzedStory(story_meta, book, first_checked, group_db, configuration.layout == "lean")
+		if duplicates:
+			duplicates.start_story()
+		story_chapters = []
 		for doc in story.analyze():
 			if stop_event.is_set():
 				progress.close()
@@ -231,22 +278,87 @@ def process_fics(configuration, es_queue: Queue, stop_event: Event):
 				break
 			if isinstance(doc, Story) and any([tag in doc.tags for tag in configuration.skip_tags]):
 				break
-			index_action = doc.to_dict()
-			# e.g. <chapters-{now/d}>
-			index_action["_index"] = f"<{doc._index._name[:-1]}" + "{now/d}>"
-			waiting = True
-			while waiting:
-				try:
-					es_queue.put(index_action, timeout=0.1)
-					waiting = False
-				except Full:
-					if stop_event.is_set():
+			docs = [doc]
+			if configuration.passages and isinstance(doc, Chapter):
+				docs.extend(Passage.from_chapter(doc, configuration.passage_size, configuration.passage_overlap))
+			for a_doc in docs:
+				if not queue_doc(a_doc, es_queue, stop_event):
+					progress.close()
+					return
+			if rollups and isinstance(doc, Story):
+				rollups.add(doc)
+			if duplicates and isinstance(doc, Chapter):
+				duplicates.add_chapter(doc)
+			if duplicates and isinstance(doc, Story):
+				duplicates.add_story(doc)
+			if embedder and isinstance(doc, Chapter):
+				story_chapters.append(doc)
+			if embedder and isinstance(doc, Story) and (ids_to_embed is None or doc.id in ids_to_embed):
+				for chunk in embed_chapters(embedder, doc.id, story_chapters, configuration.embed_batch):
+					if not queue_doc(chunk, es_queue, stop_event):
 						progress.close()
 						return
 		progress.update()
+	progress.close()
+	if rollups:
+		print(f"Indexing rollups of {len(rollups.authors)} authors and {len(rollups.tags)} tags/tag pairs by year")
+		for rollup in rollups.documents():
+			if not queue_doc(rollup, es_queue, stop_event):
+				return
+	if embedder and embedder.cache:
+		print(embedder.cache.report())
+	if duplicates:
+		print(duplicates.report())
+		found = 0
+		for duplicate in duplicates.documents():
+			if not queue_doc(duplicate, es_queue, stop_event):
+				return
+			found += 1
+		print(f"Found {found} near duplicate pairs of {configuration.dedupe}s")
+	# the doc eater stops when the event is set, let it take the last documents first
+	while not es_queue.empty() and not stop_event.is_set():
+		sleep(0.1)
 	stop_event.set()
 
 
+def embed_chapters(embedder, story_id: int, chapters: list[Chapter], batch_size: int) -> Iterable[Chunk]:
+	"""
+	Chunk and embed a story while its chapters are in memory, the same way as rag_cli.embed_story does from ES
+	"""
+	from rag_cli import ChapterOffset, chunk_story, embed_chunks
+	# partially embedded stories are left for rag_cli.embed_story to resume in their own index
+	if Chunk.embedding_progress(story_id)[0]:
+		return
+	text = ""
+	offsets = []
+	# as rag_cli.load_story, ghost chapters (negative numbers) are left out
+	for chapter in sorted(chapters, key=lambda chapter: chapter.chapter.number):
+		if chapter.chapter.number < 0:
+			continue
+		block_size = len(text)
+		offsets.append(ChapterOffset(chapter.chapter.id, chapter.chapter.number, block_size, block_size + len(chapter.chapter.text)))
+		text += chapter.chapter.text
+	if not text:
+		return
+	chunked = chunk_story(embedder, story_id, text, offsets)
+	yield from embed_chunks(embedder, chunked, batch_size)
+
+
+def queue_doc(doc: Document, es_queue: Queue, stop_event: Event) -> bool:
+	index_action = doc.to_dict()
+	# e.g. <chapters-{now/d}>
+	index_action["_index"] = f"<{doc._index._name[:-1]}" + "{now/d}>"
+	if "id" in doc.meta:
+		index_action["_id"] = doc.meta.id
+	while True:
+		try:
+			es_queue.put(index_action, timeout=0.1)
+			return True
+		except Full:
+			if stop_event.is_set():
+				return False
+
+
 def setup_elasticsearch(configuration):
 	if configuration.api_id:
 		authentication = {
@@ -265,11 +377,20 @@ def setup_elasticsearch(configuration):
 	es_transport_logger.setLevel(logging.WARNING) # don't log every single request to ES...
 	traffic_logger = logging.getLogger("urllib3")
 	traffic_logger.setLevel(logging.WARNING) # debug level will log the whole request body...
-	store_composable_template(Chapter)
-	store_composable_template(Story)
-
-
-def store_composable_template(doc_class: Type[Document]):
+	store_composable_template(Chapter, configuration.index_profile)
+	store_composable_template(Story, configuration.index_profile)
+	if configuration.passages:
+		store_composable_template(Passage, configuration.index_profile)
+	if configuration.rollups:
+		store_composable_template(AuthorRollup, configuration.index_profile)
+		store_composable_template(TagRollup, configuration.index_profile)
+	if configuration.dedupe:
+		store_composable_template(Duplicate, configuration.index_profile)
+	if configuration.embed_host:
+		store_composable_template(Chunk, vector_index=configuration.embed_vector_index)
+
+
+def store_composable_template(doc_class: Type[Document], profiles: list[str] = None, vector_index: str = "flat"):
 	conn = connections.get_connection()
 	nodes = conn.nodes.info()["_nodes"]["total"]
 	legacy_index_template = doc_class._index.as_template("ignore").to_dict()
@@ -278,11 +399,136 @@ def store_composable_template(doc_class: Type[Document]):
 	del(legacy_index_template["index_patterns"])
 	legacy_index_template["settings"]["number_of_shards"] = nodes
 	legacy_index_template["mappings"]["dynamic"] = "strict"
+	for profile in profiles or []:
+		apply_index_profile(legacy_index_template, index_prefix, profile)
+	if doc_class is Chunk:
+		apply_vector_index(legacy_index_template, vector_index)
+		# the mapping is strict and the template only applies to new indices, so today's chunks-* index needs total
+		# (added with resumable embedding) too, or every bulk write fails until tomorrow's index
+		conn.indices.put_mapping(index=index_wild, allow_no_indices=True,
+								 properties={"total": legacy_index_template["mappings"]["properties"]["total"]})
 	template_name = f"elasticfics-{index_prefix}"
-	print(f"Saving index template for {index_wild} with {nodes} shards")
+	print(f"Saving index template for {index_wild} with {nodes} shards, profiles: {profiles or ['fast']}")
 	conn.indices.put_index_template(name=template_name, template=legacy_index_template, index_patterns=[index_wild])
 
 
+MIGRATED_PREFIXES = ("chapters", "stories", "passages")
+
+
+def migrate_script(value: str) -> tuple[str, Path]:
+	# --migrate-script, e.g. chapters:derive.painless
+	index_prefix, separator, script_file = value.partition(":")
+	if not separator:
+		raise ArgumentTypeError(f"{value!r} is not index prefix:file")
+	if index_prefix not in MIGRATED_PREFIXES:
+		raise ArgumentTypeError(f"{index_prefix!r} is not migrated, choose from {', '.join(MIGRATED_PREFIXES)}")
+	script_path = Path(script_file)
+	if not script_path.is_file():
+		raise ArgumentTypeError(f"{script_file} does not exist")
+	return index_prefix, script_path
+
+
+def live_indices(index_prefix: str) -> list[str]:
+	# the indices behind the alias of a previous migration and every open index of the pattern, as the ingest keeps
+	# writing to new daily indices which aren't behind the alias
+	conn = connections.get_connection()
+	try:
+		aliased = list(conn.indices.get_alias(name=index_prefix).body.keys())
+	except NotFoundError:
+		aliased = []
+	found = conn.indices.get(index=f"{index_prefix}-*", expand_wildcards="open")
+	return list(dict.fromkeys(
+		index
+		for index in aliased + list(found.body.keys())
+		if not index.startswith(f"{index_prefix}-bench-")
+	))
+
+
+def migrate_indices(configuration) -> bool:
+	"""
+	Copy the live indices into new indices created from the current templates with a server side _reindex, then point
+	the aliases (e.g. "chapters") at the new indices and close the old ones, so they drop out of the data views.
+	Every prefix is copied before any alias changes, so a failed copy leaves all of them on the old indices.
+	:return: whether every copy succeeded
+	"""
+	conn = connections.get_connection()
+	scripts = {
+		index_prefix: script_path.read_text()
+		for index_prefix, script_path in configuration.migrate_script
+	}
+	migrated = {}
+	for doc_class in [Chapter, Story, Passage]:
+		index_prefix = doc_class._index._name[:-2]
+		old_indices = live_indices(index_prefix)
+		if not old_indices:
+			print(f"No {index_prefix} indices to migrate")
+			continue
+		if doc_class is Passage:
+			store_composable_template(Passage, configuration.index_profile)
+		script_source = ""
+		if doc_class is Chapter and configuration.layout == "lean":
+			script_source += LEAN_LAYOUT_SCRIPT
+		script_source += scripts.get(index_prefix, "")
+		new_index = f"{index_prefix}-{datetime.now(UTC):%Y.%m.%d-%H%M%S}"
+		print(f"Migrating {', '.join(old_indices)} to {new_index}")
+		conn.indices.create(index=new_index, settings={"refresh_interval": "-1"})
+		task = conn.reindex(source={"index": old_indices, "size": 500},
+							dest={"index": new_index},
+							script={"source": script_source, "lang": "painless"} if script_source else None,
+							slices="auto",
+							requests_per_second=configuration.migrate_rate,
+							wait_for_completion=False)
+		if not track_task(task["task"], index_prefix):
+			new_indices = [new for new, _ in migrated.values()] + [new_index]
+			print(f"Migration of {index_prefix} failed, {', '.join(new_indices)} are left for inspection (delete them "
+				  f"before migrating again) and the aliases are unchanged")
+			return False
+		conn.indices.put_settings(index=new_index, settings={"refresh_interval": None})
+		conn.indices.refresh(index=new_index)
+		migrated[index_prefix] = new_index, old_indices
+
+	alias_actions = []
+	for index_prefix, (new_index, old_indices) in migrated.items():
+		alias_actions.append({"add": {"index": new_index, "alias": index_prefix}})
+		alias_actions.extend(
+			{"remove": {"index": old_index, "alias": index_prefix, "must_exist": False}}
+			for old_index in old_indices
+		)
+	if alias_actions:
+		# all at once, so the searches never see a mix of old and new indices
+		conn.indices.update_aliases(actions=alias_actions)
+	for index_prefix, (new_index, old_indices) in migrated.items():
+		if configuration.migrate_delete:
+			conn.indices.delete(index=old_indices)
+		else:
+			conn.indices.close(index=old_indices)
+		print(f"{index_prefix} now points to {new_index}, {'deleted' if configuration.migrate_delete else 'closed'} "
+			  f"{', '.join(old_indices)}")
+	return True
+
+
+def track_task(task_id: str, description: str) -> bool:
+	conn = connections.get_connection()
+	progress = tqdm(desc=description, unit="doc", smoothing=0.1)
+	while True:
+		task = conn.tasks.get(task_id=task_id)
+		status = task["task"]["status"]
+		progress.total = status["total"]
+		progress.n = status["created"] + status["updated"] + status["deleted"]
+		progress.refresh()
+		if task["completed"]:
+			break
+		sleep(5)
+	progress.close()
+	if "error" in task:
+		print(task["error"])
+		return False
+	failures = task["response"]["failures"]
+	for failure in failures[:10]:
+		print(failure)
+	return not failures
+
+
 def bulk_index(es_queue: Queue, stop_event: Event):
 	es_client = connections.get_connection()
 	docs = doc_conveyor(es_queue, stop_event)
@@ -342,12 +588,47 @@ def load_config() -> Namespace:
 	basic_auth_config.add_argument("--password")
 	ingest_config.add_argument("--es-ca-cert-path", required=True)
 	ingest_config.add_argument("--es-hosts", action="append", required=True)
-	ingest_config.add_argument("--fimfarchive", type=FileType("rb"), required=True)
+	ingest_config.add_argument("--fimfarchive", type=FileType("rb"), help="required to ingest")
 	ingest_config.add_argument("--story-count", type=int, default=0)
 	ingest_config.add_argument("--start-at", type=int, default=0)
 	ingest_config.add_argument("--skip-tags", action="append", default=["Anon", "Anthro", "Advisory"])
+	ingest_config.add_argument("--skip-ids", action="append", default=[], help="story ID set file (see idsets.py)")
+	ingest_config.add_argument("--only-ids", action="append", default=[], help="story ID set file (see idsets.py)")
 	ingest_config.add_argument("--folders-db")
+	ingest_config.add_argument("--folders-lookup", help="lookup file from folders.py --export-lookup, used instead of folders-db")
+	ingest_config.add_argument("--layout", choices=["full", "lean"], default="full",
+							   help="lean: chapters keep only the story fields for filtering, the rest is in stories-*")
+	ingest_config.add_argument("--passages", action="store_true", help="also index chapters as overlapping passages")
+	ingest_config.add_argument("--passage-size", type=int, default=2000, help="characters per passage")
+	ingest_config.add_argument("--passage-overlap", type=int, default=200, help="characters shared by passages")
+	ingest_config.add_argument("--rollups", action="store_true", help="index author and tag totals at the end of the run")
+	ingest_config.add_argument("--dedupe", choices=["story", "chapter"],
+							   help="find near duplicate stories or chapters with MinHash (needs numpy)")
+	ingest_config.add_argument("--dedupe-threshold", type=float, default=0.8, help="minimum estimated similarity")
+	ingest_config.add_argument("--dedupe-capacity", type=int, default=300000,
+							   help="maximum stories/chapters held in memory, about 400 bytes each")
+	embed_config = ingest_config.add_argument_group(title="Semantic search chunks (requires the semantic search dependencies)")
+	embed_config.add_argument("--embed-host", help="STAPI URL, chunk and embed stories while ingesting them")
+	embed_config.add_argument("--embed-ids", action="append", default=[],
+							  help="story ID set file (see idsets.py) of the stories to embed (default all)")
+	embed_config.add_argument("--embed-batch", type=int, default=10, help="chunks per embedding request")
+	embed_config.add_argument("--embed-cache", type=Path,
+							  help="SQLite file of embeddings already returned by STAPI, shared with vaguesearch.toml")
+	embed_config.add_argument("--embed-model", help="model name in the embedding cache (default the embed host)")
+	embed_config.add_argument("--embed-cache-megabytes", type=float, default=2048,
+							  help="least recently used embeddings are evicted above this size")
+	embed_config.add_argument("--embed-vector-index", choices=VECTOR_INDEX_OPTIONS.keys(), default="flat",
+							  help="index_options of new chunks-* indices, the same as vector index in vaguesearch.toml")
+	ingest_config.add_argument("--index-profile", action="append", choices=INDEX_PROFILES.keys(),
+							   help="mapping/settings profile for new indices, see esdocs.INDEX_PROFILES")
 	ingest_config.add_argument("--bootstrap", default=None)
+	migrate_config = ingest_config.add_argument_group(title="Migrate existing indices to the current templates")
+	migrate_config.add_argument("--migrate", action="store_true", help="reindex instead of ingesting the fimfarchive")
+	migrate_config.add_argument("--migrate-script", action="append", default=[], type=migrate_script,
+								help="painless to run on each document, as index prefix:file, e.g. chapters:derive.painless")
+	migrate_config.add_argument("--migrate-rate", type=float, default=-1,
+								help="throttle to this many documents per second (default unthrottled)")
+	migrate_config.add_argument("--migrate-delete", action="store_true", help="delete the old indices instead of closing them")
 	return ingest_config.parse_args()
 
 def bootstrap_elasticsearh(config):
@@ -356,16 +637,18 @@ def bootstrap_elasticsearh(config):
 								  basic_auth=("elastic", config.bootstrap))
 	writer_cluster_privileges = ["monitor", "manage_index_templates"]
 	writer_index_privileges = ["monitor", "auto_configure", "write", "create_index", "view_index_metadata", "read"]
-	writer_index_patterns = ["chapters-*", "stories-*", "chunks-*"]
+	writer_index_patterns = ["chapters-*", "stories-*", "chunks-*", "passages-*", "authors-*", "tags-*", "duplicates-*"]
 	writer_index_privileges = [
 		{
 			"names": pattern,
-			"privileges": writer_index_privileges
+			"privileges": list(writer_index_privileges)
 		}
 		for pattern in writer_index_patterns
 	]
-	# add maintenance privilege to allow index refresh by semantic search script on chunks indices
-	writer_index_privileges[writer_index_patterns.index("chunks-*")]["privileges"].append("maintenance")
+	# add manage privilege to allow --migrate to change settings, close the old indices and swap the aliases
+	for migrated_pattern in ["chapters-*", "stories-*", "passages-*"]:
+		writer_index_privileges[writer_index_patterns.index(migrated_pattern)]["privileges"].append("manage")
+	writer_index_privileges.append({"names": ["chapters", "stories", "passages"], "privileges": ["manage", "read"]})
 	client.security.put_role(name="elasticfics-writer",
 							 cluster=writer_cluster_privileges,
 							 indices=writer_index_privileges)
@@ -373,7 +656,7 @@ def bootstrap_elasticsearh(config):
 							 password=config.password,
 							 roles=["elasticfics-writer"])
 	reader_index_privileges = ["read", "view_index_metadata"]
-	reader_index_patterns = ["chapters-*", "stories-*"]
+	reader_index_patterns = ["chapters-*", "stories-*", "passages-*", "authors-*", "tags-*", "duplicates-*"]
 	reader_index_privileges = [
 		{
 			"names": pattern,
@@ -459,6 +742,10 @@ if __name__ == "__main__":
 		bootstrap_elasticsearh(config_options)
 		exit(0)
 	setup_elasticsearch(config_options)
+	if config_options.migrate:
+		exit(0 if migrate_indices(config_options) else 1)
+	if config_options.fimfarchive is None:
+		exit("--fimfarchive is required to ingest")
 	# minimum: 0.1 seconds worth of chapters
 	# maximum: the time it takes for Elasticsearch to accept one bulk request
 	doc_belt = Queue(50)
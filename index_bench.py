@@ -0,0 +1,239 @@
+"""
+Measure the size/speed tradeoffs of the index profiles in esdocs.INDEX_PROFILES.
+Profiles may be combined with a "+", e.g. compact+search, and "lean" measures the lean layout of index-fics.py.
+
+For each profile, a sample of the live chapters-* indices is copied with a server side _reindex into a scratch
+index (chapters-bench-{profile}) created from a template with that profile. The time to reindex stands in for
+ingest time, since it is dominated by the same analysis and segment writing. The scratch index is force merged so
+that the sizes are comparable, then each query below is run repeatedly.
+
+The user needs the "manage" index privilege on chapters-bench-* (force merge and delete), e.g. the elastic user.
+Run it as: python index_bench.py --profile fast --profile search --profile compact+search --sample-docs 20000
+"""
+import logging
+from pathlib import PosixPath
+from statistics import median, quantiles
+from time import perf_counter
+
+from configargparse import ArgParser, Namespace
+from elasticsearch.dsl import connections
+from elasticsearch.exceptions import NotFoundError
+
+from esdocs import Chapter, INDEX_PROFILES, LEAN_LAYOUT_SCRIPT, apply_index_profile
+
+# representative Kibana searches, the phrase is substituted from --phrase
+BENCH_QUERIES = {
+	"match text": {
+		"query": {"match": {"chapter.text": "{phrase}"}},
+		"size": 20,
+	},
+	"phrase text": {
+		"query": {"match_phrase": {"chapter.text": "{phrase}"}},
+		"size": 20,
+	},
+	"tag filter, score sort": {
+		"query": {"bool": {"filter": [{"term": {"story.tags": "Romance"}}]}},
+		"sort": [{"story.score.wilson99": "desc"}],
+		"size": 50,
+	},
+	"author words agg": {
+		"size": 0,
+		"aggs": {"authors": {"terms": {"field": "story.author.id", "size": 50, "order": {"words": "desc"}},
+							  "aggs": {"words": {"sum": {"field": "chapter.words"}}}}},
+	},
+	"phrase highlight": {
+		"query": {"match_phrase": {"chapter.text": "{phrase}"}},
+		"highlight": {"fields": {"chapter.text": {}}},
+		"source": ["story.id", "chapter.number"],
+		"size": 20,
+	},
+	"phrase prefix": {
+		"query": {"match_phrase_prefix": {"chapter.text": "{phrase}"}},
+		"size": 20,
+	},
+}
+
+# the full layout has the story title on each chapter
+FULL_QUERIES = {
+	"title search": {
+		"query": {"match": {"story.title": "{phrase}"}},
+		"size": 20,
+	},
+}
+
+# these need the keyword subfields of the search profile
+KEYWORD_QUERIES = {
+	"title sort": {
+		"query": {"match": {"chapter.text": "{phrase}"}},
+		"sort": [{"story.title.keyword": "asc"}],
+		"size": 50,
+	},
+	"author name agg": {
+		"size": 0,
+		"aggs": {"authors": {"terms": {"field": "story.author.name.keyword", "size": 50}}},
+	},
+}
+
+
+def load_config() -> Namespace:
+	config_path = PosixPath(__file__).parent / "index-fics.ini"
+	bench_config = ArgParser(default_config_files=[str(config_path)], ignore_unknown_config_file_keys=True)
+	bench_config.add_argument('-c', '--config', is_config_file=True, help='config file path')
+	api_auth_config = bench_config.add_argument_group(title="API authentication (will be preferred if both are set)")
+	basic_auth_config = bench_config.add_argument_group(title="Basic authentication")
+	api_auth_config.add_argument("--api-id")
+	api_auth_config.add_argument("--api-secret")
+	basic_auth_config.add_argument("--username")
+	basic_auth_config.add_argument("--password")
+	bench_config.add_argument("--es-ca-cert-path", required=True)
+	bench_config.add_argument("--es-hosts", action="append", required=True)
+	bench_config.add_argument("--profile", action="append",
+							  help="profile (or profiles joined by +) to measure, may be repeated (default: each one)")
+	bench_config.add_argument("--sample-docs", type=int, default=20000, help="chapters copied into each scratch index")
+	bench_config.add_argument("--repeat", type=int, default=20, help="runs of each query")
+	bench_config.add_argument("--phrase", default="princess of the night")
+	bench_config.add_argument("--keep", action="store_true", help="do not delete the scratch indices")
+	return bench_config.parse_args()
+
+
+def setup_elasticsearch(configuration):
+	if configuration.api_id:
+		authentication = {
+			"api_key": (configuration.api_id, configuration.api_secret)
+		}
+	else:
+		authentication = {
+			"basic_auth": (configuration.username, configuration.password)
+		}
+	connections.create_connection(hosts=configuration.es_hosts,
+								  ca_certs=configuration.es_ca_cert_path,
+								  request_timeout=3600, # reindexing the sample waits for completion
+								  **authentication)
+	logging.getLogger('elastic_transport.transport').setLevel(logging.WARNING)
+
+
+def store_bench_template(profiles: list[str]) -> str:
+	conn = connections.get_connection()
+	template = Chapter._index.as_template("ignore").to_dict()
+	del(template["index_patterns"])
+	template["settings"]["number_of_shards"] = 1
+	template["mappings"]["dynamic"] = "strict"
+	for profile in profiles:
+		apply_index_profile(template, "chapters", profile)
+	bench_pattern = "chapters-bench-*"
+	# a higher priority than elasticfics-chapters, whose pattern chapters-* overlaps
+	conn.indices.put_index_template(name="elasticfics-bench-chapters", template=template,
+									index_patterns=[bench_pattern], priority=100)
+	return bench_pattern
+
+
+def joined_title_search(index: str, phrase: str) -> int:
+	# the lean layout has to find the stories first, see Chapter.join_stories for the other direction
+	conn = connections.get_connection()
+	stories = conn.search(index="stories-*", request_cache=False, query={"match": {"title": phrase}},
+						  source=["id"], size=100)
+	story_ids = [hit["_source"]["id"] for hit in stories["hits"]["hits"]]
+	chapters = conn.search(index=index, request_cache=False, query={"terms": {"story.id": story_ids}}, size=20)
+	return stories["took"] + chapters["took"]
+
+
+LEAN_QUERIES = {
+	"title search, joined": joined_title_search,
+}
+
+
+def time_queries(index: str, phrase: str, repeat: int, queries: dict = BENCH_QUERIES) -> dict[str, dict[str, float]]:
+	conn = connections.get_connection()
+	timings = {}
+	for name, body in queries.items():
+		if callable(body):
+			run_query = lambda: body(index, phrase)
+		else:
+			body = eval_phrase(body, phrase)
+			run_query = lambda: conn.search(index=index, request_cache=False, **body)["took"]
+		run_query() # warm up
+		walls = []
+		tooks = []
+		for _ in range(repeat):
+			start = perf_counter()
+			took = run_query()
+			walls.append((perf_counter() - start) * 1000)
+			tooks.append(took)
+		timings[name] = {
+			"took p50": median(tooks),
+			"wall p50": median(walls),
+			"wall p95": quantiles(walls, n=20)[-1] if repeat > 1 else walls[0],
+		}
+	return timings
+
+
+def eval_phrase(body, phrase: str):
+	if isinstance(body, dict):
+		return {key: eval_phrase(value, phrase) for key, value in body.items()}
+	if isinstance(body, list):
+		return [eval_phrase(value, phrase) for value in body]
+	if isinstance(body, str):
+		return body.replace("{phrase}", phrase)
+	return body
+
+
+def bench_profile(profiles: list[str], configuration: Namespace) -> dict:
+	conn = connections.get_connection()
+	lean = "lean" in profiles
+	profiles = [profile for profile in profiles if profile != "lean"]
+	queries = dict(BENCH_QUERIES)
+	if lean:
+		queries.update(LEAN_QUERIES)
+	else:
+		queries.update(FULL_QUERIES)
+		if "search" in profiles:
+			queries.update(KEYWORD_QUERIES)
+	store_bench_template(profiles)
+	index = f"chapters-bench-{'-'.join(profiles)}{'-lean' if lean else ''}"
+	try:
+		conn.indices.delete(index=index)
+	except NotFoundError:
+		pass
+	conn.indices.create(index=index)
+	start = perf_counter()
+	conn.reindex(source={"index": "chapters-*,-chapters-bench-*"},
+				 dest={"index": index},
+				 script={"source": LEAN_LAYOUT_SCRIPT} if lean else None,
+				 max_docs=configuration.sample_docs,
+				 wait_for_completion=True,
+				 refresh=True)
+	ingest_seconds = perf_counter() - start
+	conn.indices.forcemerge(index=index, max_num_segments=1)
+	stats = conn.indices.stats(index=index, metric="store,docs")
+	primaries = stats["indices"][index]["primaries"]
+	result = {
+		"index": index,
+		"docs": primaries["docs"]["count"],
+		"ingest s": ingest_seconds,
+		"size MB": primaries["store"]["size_in_bytes"] / 2**20,
+		"queries": time_queries(index, configuration.phrase, configuration.repeat, queries),
+	}
+	if not configuration.keep:
+		conn.indices.delete(index=index)
+	return result
+
+
+def print_results(results: list[dict]):
+	for result in results:
+		print(f"{result['index']}: {result['docs']} docs, {result['size MB']:.1f} MB, reindexed in {result['ingest s']:.1f}s")
+		for name, timing in result["queries"].items():
+			print(f"\t{name:<24} took p50 {timing['took p50']:>7.1f} ms  "
+				  f"wall p50 {timing['wall p50']:>7.1f} ms  wall p95 {timing['wall p95']:>7.1f} ms")
+
+
+if __name__ == "__main__":
+	my_config = load_config()
+	setup_elasticsearch(my_config)
+	results = []
+	for profile in my_config.profile or INDEX_PROFILES.keys():
+		profiles = profile.split("+")
+		for unknown in set(profiles) - INDEX_PROFILES.keys() - {"lean"}:
+			raise SystemExit(f"Unknown profile {unknown}, choose from {', '.join(INDEX_PROFILES)}")
+		results.append(bench_profile(profiles, my_config))
+	connections.get_connection().indices.delete_index_template(name="elasticfics-bench-chapters")
+	print_results(results)
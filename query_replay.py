@@ -0,0 +1,189 @@
+"""
+Replay a versioned workload of representative queries (query-workload.toml) against the indices at a given
+concurrency, and report latency percentiles and throughput. Run it before and after changing a mapping, an index
+profile or the cluster to see whether searches got faster.
+
+Run it as: python query_replay.py --workload query-workload.toml --concurrency 4 --duration 60
+A local single node cluster without security works too: --es-hosts http://localhost:9200
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from pathlib import PosixPath
+from random import Random
+from statistics import quantiles
+from threading import Lock
+from time import perf_counter
+from tomllib import load
+
+from configargparse import ArgParser, Namespace, FileType
+from elasticsearch.dsl import connections
+
+from esdocs import Chapter, Story
+
+# the esdocs lookups that are replayed, called with a story ID
+LOOKUPS = {
+	"get_multi_texts": lambda story_id: Chapter.get_multi_texts(story_id, [1]),
+	"get_title_lite": lambda story_id: Story.get_title_lite(story_id),
+}
+
+
+def load_config() -> Namespace:
+	config_path = PosixPath(__file__).parent / "index-fics.ini"
+	replay_config = ArgParser(default_config_files=[str(config_path)], ignore_unknown_config_file_keys=True)
+	replay_config.add_argument('-c', '--config', is_config_file=True, help='config file path')
+	api_auth_config = replay_config.add_argument_group(title="API authentication (will be preferred if both are set)")
+	basic_auth_config = replay_config.add_argument_group(title="Basic authentication (or none for a local cluster)")
+	api_auth_config.add_argument("--api-id")
+	api_auth_config.add_argument("--api-secret")
+	basic_auth_config.add_argument("--username")
+	basic_auth_config.add_argument("--password")
+	replay_config.add_argument("--es-ca-cert-path")
+	replay_config.add_argument("--es-hosts", action="append", required=True)
+	replay_config.add_argument("--workload", type=FileType("rb"), default=str(config_path.with_name("query-workload.toml")))
+	replay_config.add_argument("--concurrency", type=int, default=4, help="queries in flight at once")
+	replay_config.add_argument("--duration", type=float, default=60, help="seconds to replay for, after warming up")
+	replay_config.add_argument("--warmup", type=float, default=10, help="seconds of queries that are not measured")
+	replay_config.add_argument("--seed", type=int, default=0, help="seed of the query schedule, for repeatable runs")
+	replay_config.add_argument("--output", help="also write the results as JSON to this path")
+	return replay_config.parse_args()
+
+
+def setup_elasticsearch(configuration):
+	if configuration.api_id:
+		authentication = {
+			"api_key": (configuration.api_id, configuration.api_secret)
+		}
+	elif configuration.username:
+		authentication = {
+			"basic_auth": (configuration.username, configuration.password)
+		}
+	else:
+		authentication = {}
+	connections.create_connection(hosts=configuration.es_hosts,
+								  ca_certs=configuration.es_ca_cert_path,
+								  request_timeout=600,
+								  # one pooled connection per worker thread
+								  connections_per_node=configuration.concurrency,
+								  **authentication)
+	logging.getLogger('elastic_transport.transport').setLevel(logging.WARNING)
+
+
+def substitute(body, values: dict[str, str]):
+	if isinstance(body, dict):
+		return {key: substitute(value, values) for key, value in body.items()}
+	if isinstance(body, list):
+		return [substitute(value, values) for value in body]
+	if isinstance(body, str):
+		for name, value in values.items():
+			body = body.replace(f"{{{name}}}", str(value))
+		return body
+	return body
+
+
+class Replay:
+	def __init__(self, workload: dict, seed: int = 0):
+		self.workload = workload
+		self.queries = workload["query"]
+		self.weights = [query.get("weight", 1) for query in self.queries]
+		self.random = Random(seed)
+		self.random_lock = Lock()
+		self.story_ids = self.sample_story_ids(workload["params"].get("sample_stories", 200), seed)
+		self.latencies: dict[str, list[float]] = {query["name"]: [] for query in self.queries}
+		self.errors: dict[str, int] = {query["name"]: 0 for query in self.queries}
+		# += on a dict entry isn't atomic across the worker threads
+		self.errors_lock = Lock()
+
+	@staticmethod
+	def sample_story_ids(count: int, seed: int) -> list[int]:
+		search = Story.search()
+		search = search.query("function_score", random_score={"seed": seed, "field": "_seq_no"})
+		search = search.extra(source=["id"], size=count)
+		return [story.id for story in search.execute()]
+
+	def next_query(self) -> tuple[dict, dict[str, str]]:
+		params = self.workload["params"]
+		with self.random_lock:
+			query = self.random.choices(self.queries, self.weights)[0]
+			values = {
+				"phrase": self.random.choice(params["phrases"]),
+				"tag": self.random.choice(params["tags"]),
+				"story_id": self.random.choice(self.story_ids),
+			}
+		return query, values
+
+	def run_query(self, query: dict, values: dict[str, str]):
+		if "lookup" in query:
+			LOOKUPS[query["lookup"]](int(values["story_id"]))
+		else:
+			conn = connections.get_connection()
+			conn.search(index=query["index"], body=substitute(query["body"], values))
+
+	def worker(self, warm_until: float, stop_at: float):
+		while (now := perf_counter()) < stop_at:
+			query, values = self.next_query()
+			try:
+				self.run_query(query, values)
+			except Exception as e:
+				logging.warning(f"{query['name']} failed: {e}")
+				if now >= warm_until:
+					with self.errors_lock:
+						self.errors[query["name"]] += 1
+				continue
+			if now >= warm_until:
+				self.latencies[query["name"]].append((perf_counter() - now) * 1000)
+
+	def replay(self, concurrency: int, warmup: float, duration: float):
+		warm_until = perf_counter() + warmup
+		stop_at = warm_until + duration
+		with ThreadPoolExecutor(max_workers=concurrency) as pool:
+			for _ in range(concurrency):
+				pool.submit(self.worker, warm_until, stop_at)
+
+	def results(self, duration: float) -> dict:
+		results = {
+			"workload version": self.workload["version"],
+			"duration s": duration,
+			"queries": {},
+		}
+		total = 0
+		for name, latencies in self.latencies.items():
+			total += len(latencies)
+			if len(latencies) < 2:
+				results["queries"][name] = {"count": len(latencies), "errors": self.errors[name]}
+				continue
+			percentiles = quantiles(latencies, n=100, method="inclusive")
+			results["queries"][name] = {
+				"count": len(latencies),
+				"errors": self.errors[name],
+				"p50 ms": percentiles[49],
+				"p95 ms": percentiles[94],
+				"p99 ms": percentiles[98],
+				"per s": len(latencies) / duration,
+			}
+		results["per s"] = total / duration
+		return results
+
+
+def print_results(results: dict):
+	print(f"Workload version {results['workload version']}, {results['per s']:.1f} queries/s overall")
+	print(f"{'query':<32} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'per s':>7}")
+	for name, result in results["queries"].items():
+		if "p50 ms" not in result:
+			print(f"{name:<32} {result['count']:>6} {result['errors']:>6}")
+			continue
+		print(f"{name:<32} {result['count']:>6} {result['errors']:>6} {result['p50 ms']:>8.1f} "
+			  f"{result['p95 ms']:>8.1f} {result['p99 ms']:>8.1f} {result['per s']:>7.1f}")
+
+
+if __name__ == "__main__":
+	my_config = load_config()
+	setup_elasticsearch(my_config)
+	my_workload = load(my_config.workload)
+	replay = Replay(my_workload, my_config.seed)
+	print(f"Replaying {len(replay.queries)} queries with {my_config.concurrency} in flight for {my_config.duration}s...")
+	replay.replay(my_config.concurrency, my_config.warmup, my_config.duration)
+	my_results = replay.results(my_config.duration)
+	print_results(my_results)
+	if my_config.output:
+		PosixPath(my_config.output).write_text(dumps(my_results, indent="\t"))
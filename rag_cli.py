@@ -7,20 +7,22 @@ from textwrap import dedent
 from collections import namedtuple
 from tomllib import load
 from csv import DictReader, Error as CSVError
+from concurrent.futures import ThreadPoolExecutor
 from sys import stdout
 
-from chonkie import SemanticChunker
 from configargparse import ArgParser, Namespace, FileType
 from elasticsearch.dsl import connections, Q
 
-from adapters import STAPIEmbeddings, LlamacppAPI
-from esdocs import Chapter, Chunk, Story
+from adapters import STAPIEmbeddings, LlamacppAPI, LocalTokenizer
+from esdocs import Chapter, Chunk, Story, VECTOR_INDEX_OPTIONS, apply_vector_index
 
-from typing import Type, Union
+from typing import Type, Union, Iterable
 from elasticsearch.dsl import Document
 from elasticsearch import NotFoundError
+from elasticsearch.helpers import bulk
 
 ChapterOffset = namedtuple("ChapterOffset", ["id", "number", "start", "end"])
+vaguelogger = logging.getLogger("vaguelogger")
 
 
 def load_config() -> Namespace:
@@ -41,6 +43,85 @@ def load_config() -> Namespace:
 	args.vaguesearch = vaguesearch
 	return args
 
+def make_embedder(configuration: Namespace) -> STAPIEmbeddings:
+	"""
+	The STAPI client from llms.embedding of vaguesearch.toml, with the local embedding cache if it is configured
+	"""
+	embedding_config = configuration.vaguesearch["llms"]["embedding"]
+	cache = None
+	if "cache" in embedding_config:
+		from embedcache import EmbeddingCache
+		cache_config = embedding_config["cache"]
+		cache = EmbeddingCache(PosixPath(cache_config["path"]).expanduser(),
+							   embedding_config.get("model", embedding_config["stapi host"]),
+							   cache_config.get("max megabytes", 2048), cache_config.get("dtype", "float16"))
+	tokenizer = None
+	if "tokenizer" in embedding_config:
+		# STAPI counts the special tokens too
+		tokenizer = LocalTokenizer(embedding_config["tokenizer"], special_tokens=True)
+	return STAPIEmbeddings(embedding_config["stapi host"], cache, tokenizer, timeout=embedding_config.get("timeout", 60),
+						   concurrency=embedding_config.get("concurrent requests", 4))
+
+def make_chatter(configuration: Namespace) -> LlamacppAPI:
+	"""
+	The llama.cpp client from llms.chat of vaguesearch.toml, counting tokens locally if a tokenizer is configured
+	"""
+	chat_config = configuration.vaguesearch["llms"]["chat"]
+	tokenizer = None
+	if "tokenizer" in chat_config:
+		tokenizer = LocalTokenizer(chat_config["tokenizer"])
+	return LlamacppAPI(chat_config["host"], tokenizer, timeout=chat_config.get("timeout", 600),
+					   concurrency=chat_config.get("concurrent requests", 1))
+
+def pack_chunks(chatter: LlamacppAPI, chunks: list[Chunk], system_prompt: str, question: str,
+				min_answer_tokens: int, overhead: int = 10) -> str:
+	"""
+	Fill the context with as many of the chunks as fit in front of the answer, in order, marking them to_chat
+	:param system_prompt: with a {chunks} placeholder
+	:param overhead: tokens of the chat template around the prompts
+	:return: the chunks to put in the system prompt
+	"""
+	budget = chatter.context - min_answer_tokens - overhead
+	budget -= sum(chatter.count_tokens_batch([system_prompt.format(chunks=""), question]))
+	rag_chunks = ""
+	# the chunks are counted a batch at a time, the context is usually full long before the last one
+	for batch in batched(chunks, chatter.workers):
+		if budget < 0:
+			break
+		blobs = [chunk.as_blob() for chunk in batch]
+		budget, fitted = fit_chunks(batch, blobs, chatter.count_tokens_batch(blobs), budget)
+		rag_chunks += fitted
+	return rag_chunks
+
+async def apack_chunks(chatter: LlamacppAPI, chunks: list[Chunk], system_prompt: str, question: str,
+					   min_answer_tokens: int, overhead: int = 10) -> str:
+	"""
+	pack_chunks for the event loop
+	"""
+	budget = chatter.context - min_answer_tokens - overhead
+	budget -= sum(await chatter.acount_tokens_batch([system_prompt.format(chunks=""), question]))
+	rag_chunks = ""
+	for batch in batched(chunks, chatter.workers):
+		if budget < 0:
+			break
+		blobs = [chunk.as_blob() for chunk in batch]
+		budget, fitted = fit_chunks(batch, blobs, await chatter.acount_tokens_batch(blobs), budget)
+		rag_chunks += fitted
+	return rag_chunks
+
+def fit_chunks(chunks: Iterable[Chunk], blobs: list[str], counts: list[int], budget: int) -> tuple[int, str]:
+	"""
+	:return: the tokens left, negative once a chunk didn't fit, and the blobs of the chunks which fit
+	"""
+	rag_chunks = ""
+	for chunk, blob, tokens in zip(chunks, blobs, counts):
+		budget -= tokens
+		if budget < 0:
+			break
+		chunk.to_chat = True
+		rag_chunks += blob
+	return budget, rag_chunks
+
 def setup_logging():
 	vaguelogger = logging.getLogger("vaguelogger")
 	vaguelogger.setLevel(logging.INFO)
@@ -70,10 +151,16 @@ def setup_elasticsearch(configuration):
 	traffic_logger = logging.getLogger("urllib3")
 	traffic_logger.setLevel(logging.WARNING) # debug level will log the whole request body...
 
-	store_composable_template(Chunk)
+	vector_index = configuration.vaguesearch["llms"]["embedding"].get("vector index", "flat")
+	if vector_index not in VECTOR_INDEX_OPTIONS:
+		raise ValueError(f"Unknown vector index {vector_index}, choose from {', '.join(VECTOR_INDEX_OPTIONS)}")
+	store_composable_template(Chunk, vector_index)
 
 
-def store_composable_template(doc_class: Type[Document]):
+def store_composable_template(doc_class: Type[Document], vector_index: str = "flat"):
+	"""
+	:param vector_index: key of esdocs.VECTOR_INDEX_OPTIONS, for Chunk
+	"""
 	conn = connections.get_connection()
 	nodes = conn.nodes.info()["_nodes"]["total"]
 	legacy_index_template = doc_class._index.as_template("ignore").to_dict()
@@ -82,6 +169,11 @@ def store_composable_template(doc_class: Type[Document]):
 	del(legacy_index_template["index_patterns"])
 	legacy_index_template["settings"]["number_of_shards"] = nodes
 	legacy_index_template["mappings"]["dynamic"] = "strict"
+	if doc_class is Chunk:
+		apply_vector_index(legacy_index_template, vector_index)
+		# indices created before Chunk.total existed reject it under the strict mapping
+		conn.indices.put_mapping(index=index_wild, allow_no_indices=True,
+								 properties={"total": legacy_index_template["mappings"]["properties"]["total"]})
 	template_name = f"elasticfics-{index_prefix}"
 	try:
 		found_tmpl =conn.indices.get_index_template(name=template_name)
@@ -124,63 +216,18 @@ def load_story(story_id: int) -> tuple[str, list[ChapterOffset]]:
 	return text, offsets
 
 
-def reconstruct_chunks(chunks: list[Chunk], context: bool = False):
-	story_id = chunks[0].story.id
-	story_search = Story.search()
-	story_search = story_search.filter(Q("term", id=story_id))
-	story_search = story_search.extra(source=["deleted"], size=1)
-	story_results = story_search.execute()
-	chapter2get = set()
-	for chunk in chunks:
-		chapter2get.update(chunk.chapter.number)
-	chapter_matches = [
-		Q("term", chapter__number=chapter)
-		for chapter in chapter2get
-	]
-	story_filter = Q("term", story__id=story_id)
-	chapter_filter = Q("bool", must=story_filter, should=chapter_matches, minimum_should_match=1)
-	search = Chapter.search()
-	search = search.params(source=["chapter.number", "chapter.text", "chapter.id"], size=len(chapter2get))
-	search = search.filter(chapter_filter)
-	resp = search.execute()
-	if resp.hits.total.value != len(chapter2get):
-		vaguelogger.warning(f"the wrong number of chapters are in ES for {search.to_dict()}")
-	chapter_texts = {
-		hit.chapter.number: hit.chapter.text
-		for hit in resp.hits
-	}
-
-	for chunk in chunks:
-		segment = ""
-		for i, chapter in enumerate(chunk.chapter.number):
-			slice_start = chunk.chapter.start[i]
-			slice_end = chunk.chapter.end[i]
-			segment += chapter_texts[chapter][slice_start:slice_end]
-			if not hasattr(chunk, "pcent"):
-				chunk.pcent = f"{len(segment) / len(chapter_texts[chapter]):.0%}"
-		if story_results.hits[0].deleted:
-			chunk.link = f"https://fimfetch.net/story/{story_id}/a/{chunk.chapter.number[0]}"
-		else:
-			chunk.link = f"https://www.fimfiction.net/story/{story_id}/{chunk.chapter.id[0]}"
-		chunk.text = segment
-	return chunks
-
-
-def embed_story(embedder: STAPIEmbeddings, story_id: int):
-	start = time()
-	if Chunk.is_embedded(story_id):
-		return
-	chunker = SemanticChunker(embedding_model=embedder, chunk_size=512, skip_window=2)
-	story, offsets = load_story(story_id)
-	step = time()
-	vaguelogger.info(f"{step - start:.2f}s loading story")
-	start = step
+def chunk_story(embedder: STAPIEmbeddings, story_id: int, story: str, offsets: list[ChapterOffset]) -> list:
+	"""
+	Semantically chunk a story's text, the chapters joined in order, and attach a Chunk document to each chunk as .doc
+	:param offsets: where each chapter is in the story text, its start and end offsets are slices of the story text
+	:return: chonkie chunks, each with .text and .doc
+	"""
+	from chonkie import SemanticChunker
+	chunker = SemanticChunker(embedding_model=embedder.chunker_embeddings(), chunk_size=512, skip_window=2)
 	chunked = chunker.chunk(story)
-	step = time()
-	vaguelogger.info(f"{step - start:.2f}s chunking")
-	start = step
 	for i, chunk in enumerate(chunked):
-		es_chunk = Chunk(order=i)
+		# the same chunk of the same story always has the same _id, so storing it twice overwrites it
+		es_chunk = Chunk(order=i, total=len(chunked), meta={"id": f"{story_id}-{i}"})
 		es_chunk.story.id = story_id
 		involved_filter = lambda chapter: chunk.start_index < chapter.end and chunk.end_index > chapter.start
 		involved_chapters = list(filter(involved_filter, offsets))
@@ -194,15 +241,80 @@ def embed_story(embedder: STAPIEmbeddings, story_id: int):
 			text_start = chunk.start_index - chapter.start
 			es_chunk.chapter.start.append(max(0, text_start))
 			es_chunk.chapter.end.append(min(chapter.end, chunk.end_index) - chapter.start)
+		chunk.doc = es_chunk
+	return chunked
 
 
-		#es_chunk.save(index=f"<{es_chunk._index._name[:-1]}" + "{now/d}>")
-		chunk.doc = es_chunk
-	for batch in batched(chunked, 10):
+def embed_batches(embedder: STAPIEmbeddings, chunked: list, batch_size: int = 10) -> Iterable[list[Chunk]]:
+	# one embedding request per batch of chunks
+	for batch in batched(chunked, batch_size):
 		texts = [chunk.text for chunk in batch]
 		for chunk, embedding in zip(batch, embedder.final_embed(texts)):
 			chunk.doc.embeddings = embedding
-			chunk.doc.save(index=f"<{chunk.doc._index._name[:-1]}" + "{now/d}>")
+		yield [chunk.doc for chunk in batch]
+
+
+def embed_chunks(embedder: STAPIEmbeddings, chunked: list, batch_size: int = 10) -> Iterable[Chunk]:
+	for batch in embed_batches(embedder, chunked, batch_size):
+		yield from batch
+
+
+def store_chunks(embedder: STAPIEmbeddings, chunked: list, index: str, batch_size: int = 10):
+	"""
+	Embed the chunks a batch at a time, and bulk index each batch while the next one is being embedded.
+	The last bulk waits for a refresh, so the whole story is searchable when this returns.
+	"""
+	conn = connections.get_connection()
+	with ThreadPoolExecutor(max_workers=1) as writer:
+		stored = None
+		for is_last, batch in flag_last(embed_batches(embedder, chunked, batch_size)):
+			actions = [{"_index": index, "_id": doc.meta.id, "_source": doc.to_dict()} for doc in batch]
+			if stored:
+				stored.result()
+			stored = writer.submit(bulk, conn, actions, refresh="wait_for" if is_last else False)
+		if stored:
+			stored.result()
+
+
+def flag_last(items: Iterable) -> Iterable[tuple[bool, object]]:
+	# pairs each item with whether it is the last one, without reading ahead more than one item
+	iterator = iter(items)
+	try:
+		current = next(iterator)
+	except StopIteration:
+		return
+	for upcoming in iterator:
+		yield False, current
+		current = upcoming
+	yield True, current
+
+
+def embed_story(embedder: STAPIEmbeddings, story_id: int):
+	start = time()
+	stored, total, index = Chunk.embedding_progress(story_id)
+	# chunks from before Chunk.total can't tell whether they are complete, so they are taken as complete
+	if stored and (total is None or stored >= total):
+		return
+	story, offsets = load_story(story_id)
+	step = time()
+	vaguelogger.info(f"{step - start:.2f}s loading story")
+	start = step
+	chunked = chunk_story(embedder, story_id, story, offsets)
+	step = time()
+	vaguelogger.info(f"{step - start:.2f}s chunking")
+	start = step
+	story_filter = Q("term", story__id=story_id)
+	if stored and total == len(chunked):
+		# resume a partially embedded story in the index it was started in
+		done = {hit.order for hit in Chunk.search().filter(story_filter).source(["order"]).scan()}
+		chunked = [chunk for chunk in chunked if chunk.doc.order not in done]
+		vaguelogger.info(f"resuming story {story_id} with {len(chunked)} of {total} chunks left")
+	else:
+		if stored:
+			# the story was chunked differently, e.g. with another embedding model
+			Chunk.search().filter(story_filter).delete()
+		index = f"<{Chunk._index._name[:-1]}" + "{now/d}>"
+	store_chunks(embedder, chunked, index)
 	step = time()
 	vaguelogger.info(f"{step - start:.2f}s embedding")
 
@@ -214,10 +326,9 @@ def wring_rag(story_id: int, params: dict, embedder: STAPIEmbeddings, chatter: L
 	prompt = prompt.strip() + " "
 	relevance_query = params["story"]["one"]["relevance question"]
 	relevance_query = dedent(relevance_query)
-	relevance_query = prompt + relevance_query.strip()
+	relevance_query = relevance_query.strip()
 	start = time()
-	relevance_vector = embedder.final_embed([relevance_query])[0]
-	Chunk._index.refresh()
+	relevance_vector = embedder.final_embed([relevance_query], prompt)[0]
 	try:
 		chunks = Chunk.find_related(story_id, relevance_vector)
 		step = time()
@@ -231,22 +342,9 @@ def wring_rag(story_id: int, params: dict, embedder: STAPIEmbeddings, chatter: L
 	if user_question == "relevance question":
 		user_question = dedent(params["story"]["one"]["relevance question"]).strip()
 
-	rag_chunks = ""
-	chat_tokens = chatter.count_tokens(system_prompt.format(chunks="")) + chatter.count_tokens(
-		user_question) + 10
-	max_prompt = chatter.context - params["llms"]["chat"]["min answer tokens"]
-	for chunk in chunks:
-		chat_tokens += chatter.count_tokens(chunk.as_blob())
-		if chat_tokens > max_prompt:
-			break
-		chunk.to_chat = True
-		rag_chunks += chunk.as_blob()
+	rag_chunks = pack_chunks(chatter, chunks, system_prompt, user_question, params["llms"]["chat"]["min answer tokens"])
 
 	system_prompt = system_prompt.format(chunks=rag_chunks)
-	#chat_response = chatter.chat_response(system_prompt + user_question)
-	chat_response = chatter.chat_response2(system_prompt, user_question)
-	step = time()
-	vaguelogger.info(f"{step - start:.2f}s asking")
 	story_title = Story.get_title_lite(story_id) + ".txt"
 	answer_path = PosixPath(params["story"]["many"]["log"])
 	if not answer_path.is_absolute():
@@ -260,11 +358,25 @@ def wring_rag(story_id: int, params: dict, embedder: STAPIEmbeddings, chatter: L
 	with answer_path.open("w") as fp:
 		fp.write(user_question)
 		fp.write("\n==================================================\n")
-		fp.write(chat_response)
+		write_answer(chatter, system_prompt, user_question, fp)
+		step = time()
+		vaguelogger.info(f"{step - start:.2f}s asking")
 		fp.write("\n==================================================\n")
 		for chunk in chunks:
 			fp.write(chunk.as_blob(True))
 
+def write_answer(chatter: LlamacppAPI, system_prompt: str, question: str, fp):
+	"""
+	Stream the answer into the answer file and stdout as llama.cpp generates it
+	"""
+	#chat_response = chatter.chat_response(system_prompt + question)
+	for content in chatter.stream_response2(system_prompt, question):
+		fp.write(content)
+		fp.flush()
+		stdout.write(content)
+		stdout.flush()
+	stdout.write("\n")
+
 def load_csv_maybe(csv_path: str, column: str) -> Union[list[int], bool]:
 	csv_in_path = PosixPath(csv_path)
 	if not csv_in_path.is_absolute():
@@ -286,20 +398,21 @@ def load_csv_maybe(csv_path: str, column: str) -> Union[list[int], bool]:
 if __name__ == "__main__":
 	step = time()
 	setup_logging()
-	vaguelogger = logging.getLogger("vaguelogger")
 	vaguelogger.info(f"{step - start:.2f}s loading")
 	my_config = load_config()
 	setup_elasticsearch(my_config)
 
-	embedder = STAPIEmbeddings(my_config.vaguesearch["llms"]["embedding"]["stapi host"])
+	embedder = make_embedder(my_config)
 
-	llama_cpp_client = LlamacppAPI(my_config.vaguesearch["llms"]["chat"]["host"])
+	llama_cpp_client = make_chatter(my_config)
 
 	story_ids_maybe = load_csv_maybe(my_config.vaguesearch["story"]["many"]["list"],
 									 my_config.vaguesearch["story"]["many"]["id column"])
 	if story_ids_maybe:
 		for story in story_ids_maybe:
 			wring_rag(story, my_config.vaguesearch, embedder, llama_cpp_client)
+		if embedder.cache:
+			vaguelogger.info(embedder.cache.report())
 		exit()
 	embed_story(embedder, my_config.vaguesearch["story"]["one"]["id"])
 
@@ -308,10 +421,13 @@ if __name__ == "__main__":
 	Query: {query}
 	"""
 	prompt = dedent(prompt).strip()
-	prompt = prompt.format(query=dedent(my_config.vaguesearch["story"]["one"]["relevance question"]).strip())
+	# the instruction is passed separately, it is part of the embedding cache key
+	prompt = prompt.format(query="")
+	query = dedent(my_config.vaguesearch["story"]["one"]["relevance question"]).strip()
 	start = time()
-	prompt_embed = embedder.final_embed([prompt])[0]
-	Chunk._index.refresh()
+	prompt_embed = embedder.final_embed([query], prompt)[0]
+	if embedder.cache:
+		vaguelogger.info(embedder.cache.report())
 
 	try:
 		chunks = Chunk.find_related(my_config.vaguesearch["story"]["one"]["id"], prompt_embed)
@@ -327,24 +443,15 @@ if __name__ == "__main__":
 	if user_question == "relevance question":
 		user_question = dedent(my_config.vaguesearch["story"]["one"]["relevance question"]).strip()
 
-	rag_chunks = ""
-	chat_tokens = llama_cpp_client.count_tokens(system_prompt.format(chunks="")) + llama_cpp_client.count_tokens(user_question) + 10
-	max_prompt = llama_cpp_client.context - my_config.vaguesearch["llms"]["chat"]["min answer tokens"]
-	for chunk in chunks:
-		chat_tokens += llama_cpp_client.count_tokens(chunk.as_blob())
-		if chat_tokens > max_prompt:
-			break
-		chunk.to_chat = True
-		rag_chunks += chunk.as_blob()
+	rag_chunks = pack_chunks(llama_cpp_client, chunks, system_prompt, user_question,
+							 my_config.vaguesearch["llms"]["chat"]["min answer tokens"])
 
 	system_prompt = system_prompt.format(chunks=rag_chunks)
-	#chat_response = llama_cpp_client.chat_response(system_prompt + user_question)
-	chat_response = llama_cpp_client.chat_response2(system_prompt, user_question)
 
 	with open("ragout.txt", "w") as fp:
 		fp.write(user_question)
 		fp.write("\n==================================================\n")
-		fp.write(chat_response)
+		write_answer(llama_cpp_client, system_prompt, user_question, fp)
 		fp.write("\n==================================================\n")
 		for chunk in chunks:
 			fp.write(chunk.as_blob(True))
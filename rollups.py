@@ -0,0 +1,104 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, UTC
+from itertools import combinations
+
+from typing import Iterator, Optional, Union
+
+from esdocs import Story, AuthorRollup, TagRollup
+
+
+@dataclass
+class Tally:
+	stories: int = 0
+	words: int = 0
+	views: int = 0
+	rated: int = 0
+	wilson99_sum: float = 0.0
+	wilson99_words: float = 0.0
+	wilson99_min: Optional[float] = None
+	wilson99_max: Optional[float] = None
+	deciles: list[int] = field(default_factory=lambda: [0] * 10)
+	first_published: Optional[datetime] = None
+	last_published: Optional[datetime] = None
+
+	def add(self, story: Story, published: Optional[datetime]):
+		self.stories += 1
+		self.words += story.words or 0
+		self.views += story.views or 0
+		wilson99 = story.score.wilson99
+		if wilson99 is not None:
+			self.rated += 1
+			self.wilson99_sum += wilson99
+			self.wilson99_words += wilson99 * (story.words or 0)
+			self.wilson99_min = wilson99 if self.wilson99_min is None else min(self.wilson99_min, wilson99)
+			self.wilson99_max = wilson99 if self.wilson99_max is None else max(self.wilson99_max, wilson99)
+			self.deciles[min(int(wilson99 * 10), 9)] += 1
+		if published:
+			if self.first_published is None or published < self.first_published:
+				self.first_published = published
+			if self.last_published is None or published > self.last_published:
+				self.last_published = published
+
+	@property
+	def wilson99_avg(self) -> Optional[float]:
+		return self.wilson99_sum / self.rated if self.rated else None
+
+
+class Rollups:
+	"""
+	Per-author and per-tag (and tag pair, per year) totals, accumulated from the stories as they are ingested.
+	They are indexed at the end of the run into authors-* and tags-*, so dashboards about authors and tags query
+	a few thousand small documents instead of aggregating millions of chapters.
+	"""
+	def __init__(self):
+		self.authors: dict[int, Tally] = defaultdict(Tally)
+		self.author_names: dict[int, str] = {}
+		self.tags: dict[tuple[tuple[str, ...], int], Tally] = defaultdict(Tally)
+
+	@staticmethod
+	def published(story: Story) -> Optional[datetime]:
+		published: Union[str, datetime, None] = story.published
+		if isinstance(published, str):
+			published = datetime.fromisoformat(published)
+		return published
+
+	def add(self, story: Story):
+		published = self.published(story)
+		self.authors[story.author.id].add(story, published)
+		self.author_names[story.author.id] = story.author.name
+		year = published.year if published else 0
+		tags = sorted(set(story.tags or []))
+		for tag in tags:
+			self.tags[((tag,), year)].add(story, published)
+		for pair in combinations(tags, 2):
+			self.tags[(pair, year)].add(story, published)
+
+	def documents(self) -> Iterator[Union[AuthorRollup, TagRollup]]:
+		for author_id, tally in self.authors.items():
+			rollup = AuthorRollup(meta={"id": author_id})
+			rollup.author.id = author_id
+			rollup.author.name = self.author_names[author_id]
+			rollup.stories = tally.stories
+			rollup.words = tally.words
+			rollup.views = tally.views
+			rollup.wilson99_words = tally.wilson99_words
+			rollup.score.wilson99_min = tally.wilson99_min
+			rollup.score.wilson99_avg = tally.wilson99_avg
+			rollup.score.wilson99_max = tally.wilson99_max
+			rollup.score.deciles = tally.deciles
+			rollup.score.unrated = tally.stories - tally.rated
+			rollup.first_published = tally.first_published
+			rollup.last_published = tally.last_published
+			yield rollup
+		for (tags, year), tally in self.tags.items():
+			rollup = TagRollup(meta={"id": f"{'|'.join(tags)}|{year}"})
+			rollup.tags = list(tags)
+			rollup.pair = len(tags) == 2
+			if year:
+				rollup.year = datetime(year, 1, 1, tzinfo=UTC)
+			rollup.stories = tally.stories
+			rollup.words = tally.words
+			rollup.views = tally.views
+			rollup.wilson99_avg = tally.wilson99_avg
+			yield rollup
@@ -1,20 +1,24 @@
 from pathlib import PosixPath
 from textwrap import dedent
 from nicegui import ui, app
-from nicegui.ui import page, run, expansion, label, row, link, textarea, button, number, markdown, input
+from nicegui.ui import page, run, expansion, label, row, column, link, textarea, button, number, markdown, input
 from nicegui.run import io_bound
+from asyncio import gather
+from collections.abc import AsyncIterator
+from contextlib import nullcontext, aclosing
 
 from esdocs import Chunk, Story
-from rag_cli import setup_elasticsearch, load_config, embed_story, load_csv_maybe
-from adapters import STAPIEmbeddings, LlamacppAPI
+from rag_cli import setup_elasticsearch, load_config, embed_story, load_csv_maybe, make_embedder, make_chatter, apack_chunks
 
 def startup():
 	my_config = load_config()
 	app.storage.general.my_config = my_config
-	app.storage.general.embedder = STAPIEmbeddings(my_config.vaguesearch["llms"]["embedding"]["stapi host"])
-	app.storage.general.llama_cpp_client = LlamacppAPI(my_config.vaguesearch["llms"]["chat"]["host"])
+	app.storage.general.embedder = make_embedder(my_config)
+	app.storage.general.llama_cpp_client = make_chatter(my_config)
 	setup_elasticsearch(my_config)
 
+async def shutdown():
+	await gather(app.storage.general.embedder.aclose(), app.storage.general.llama_cpp_client.aclose())
 
 def relevance_gradient(relevancy: float) -> tuple[int, float, float]:
 	if relevancy < 0.5:
@@ -118,58 +122,61 @@ def chunk_card3(chunk: Chunk, live: bool=True):
 		if len(chunk.text) > 80:
 				label(chunk.text)
 
-def load_chunks(story_id: int, question: str):
+async def load_chunks(story_id: int, question: str):
 	embedding_config = app.storage.general.my_config.vaguesearch["llms"]["embedding"]["prompt"]
 	embedder = app.storage.general.embedder
 	prompt = dedent(embedding_config["s2p"]).strip() + " "
-	prompt += question
-	embedded_prompt = embedder.final_embed([prompt])[0]
+	embedded_prompt = (await embedder.afinal_embed([question], prompt))[0]
 	try:
-		Chunk._index.refresh()
-		chunks = Chunk.find_related(story_id, embedded_prompt)
+		chunks = await io_bound(Chunk.find_related, story_id, embedded_prompt)
 	except ValueError:
 		label("No semantically related chunks found.")
 		return
 	return chunks
 
-def prompt_and_context(chunks: list[Chunk], question: str):
+async def prompt_and_context(chunks: list[Chunk], question: str) -> AsyncIterator[str]:
 	llama_cpp_client = app.storage.general.llama_cpp_client
 	chat_config = app.storage.general.my_config.vaguesearch["llms"]["chat"]
 	system_prompt = dedent(chat_config["system prompt"]).strip()
 	system_prompt += "\n{chunks}"
-	rag_chunks = ""
-	chat_tokens = llama_cpp_client.count_tokens(system_prompt.format(chunks=""))
-	chat_tokens += llama_cpp_client.count_tokens(question)
-	max_prompt = llama_cpp_client.context - chat_config["min answer tokens"]
-	for chunk in chunks:
-		chat_tokens += llama_cpp_client.count_tokens(chunk.as_blob())
-		if chat_tokens > max_prompt:
-			break
-		chunk.to_chat = True
-		rag_chunks += chunk.as_blob()
+	# as before, nothing is set aside for the chat template here
+	rag_chunks = await apack_chunks(llama_cpp_client, chunks, system_prompt, question, chat_config["min answer tokens"],
+									overhead=0)
 
 	system_prompt = system_prompt.format(chunks=rag_chunks)
 	#return llama_cpp_client.chat_response(system_prompt + question)
-	return llama_cpp_client.chat_response2(system_prompt, question)
+	async with aclosing(llama_cpp_client.astream_response2(system_prompt, question)) as answer:
+		async for content in answer:
+			yield content
 
-async def process_story(story_id: int, semantic_search: str, chat_question: str):
+async def process_story(story_id: int, semantic_search: str, chat_question: str, container=None):
+	"""
+	:param container: where to put the story's results, for stories processed side by side
+	"""
 	embedder = app.storage.general.embedder
 	title = Story.get_title_lite(story_id)[0:300]
-	with expansion(title, value=True) as story_fold:
+	with container if container is not None else nullcontext(), expansion(title, value=True) as story_fold:
 		placeholder = label("Embedding")
+		# chunking needs the whole story and STAPI's token counts, so it stays in a thread
 		await io_bound(embed_story, embedder, story_id)
 		placeholder.text = "Retrieving"
-		try:
-			chunks = await io_bound(load_chunks, story_id, semantic_search)
-		except ValueError:
+		chunks = await load_chunks(story_id, semantic_search)
+		if chunks is None:
+			placeholder.delete()
 			return
 		placeholder.text = "Asking..."
 		story_fold.update()
-		chat_response = await io_bound(prompt_and_context, chunks, chat_question)
-		try:
-			markdown(chat_response)
-		except AttributeError:
-			markdown("Failure to convert chat response to markdown")
+		answer = markdown()
+		chat_response = ""
+		async with aclosing(prompt_and_context(chunks, chat_question)) as contents:
+			async for content in contents:
+				if not chat_response:
+					placeholder.text = "Answering..."
+				chat_response += content
+				try:
+					answer.content = chat_response
+				except AttributeError:
+					answer.content = "Failure to convert chat response to markdown"
 		for chunk in chunks:
 			chunk_card2(chunk)
 		placeholder.delete()
@@ -266,10 +273,25 @@ async def vaguesearch():
 	async def many_go_click():
 		many_list.delete()
 		many_go.disable()
-		for story_id in load_csv_maybe(csv_path.value, my_config.vaguesearch["story"]["many"]["id column"]):
-			await process_story(story_id, relevance_question.value, analysis_question.value)
-		many_go.enable()
+		story_ids = load_csv_maybe(csv_path.value, my_config.vaguesearch["story"]["many"]["id column"])
+		# a container per story keeps them in order, while the backends' limits decide how many run at once
+		containers = [column().classes("w-full") for _ in story_ids]
+		try:
+			# one story failing (STAPI timing out, no chapters...) shouldn't stop the others
+			results = await gather(*(
+				process_story(story_id, relevance_question.value, analysis_question.value, container)
+				for story_id, container in zip(story_ids, containers)
+			), return_exceptions=True)
+			for story_id, container, result in zip(story_ids, containers, results):
+				if isinstance(result, Exception):
+					with container:
+						label(f"{story_id} failed: {result!r}").style("color: red")
+		finally:
+			many_go.enable()
 	many_go.on_click(many_go_click)
 
 app.on_startup(startup)
-run(host="127.0.0.1", title="Vaguesearch")
+app.on_shutdown(shutdown)
+# nicegui imports this file again as __mp_main__ in its server process, anything else is an import (e.g. the import time check)
+if __name__ in {"__main__", "__mp_main__"}:
+	run(host="127.0.0.1", title="Vaguesearch")
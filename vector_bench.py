@@ -0,0 +1,197 @@
+"""
+Measure the size/speed/recall tradeoffs of the vector index options in esdocs.VECTOR_INDEX_OPTIONS for chunks-*.
+
+The chunks of a sample of stories are embedded once (stories which are already in chunks-* are not embedded again),
+then copied with a server side _reindex into a scratch index (vectorbench-{option}) per option, created from a
+template with that option. The scratch indices are outside chunks-*, so the search tools never see them. Each one is
+force merged so that the sizes are comparable, then every question is asked of every story with Chunk.find_related.
+The top k chunks of each option are compared to those of flat, which scores the float vectors exactly, for recall@k.
+
+The user needs the "manage" index privilege on vectorbench-* (force merge, disk usage and delete), e.g. the elastic user.
+Run it as: python vector_bench.py --vaguesearch vaguesearch.toml --option int8_hnsw --option bbq_hnsw --sample-stories 50
+"""
+import logging
+from pathlib import PosixPath
+from statistics import median, quantiles, mean
+from textwrap import dedent
+from time import perf_counter
+from tomllib import load
+
+from configargparse import ArgParser, Namespace, FileType
+from elasticsearch.dsl import connections
+from elasticsearch.exceptions import NotFoundError
+
+from esdocs import Chunk, VECTOR_INDEX_OPTIONS, apply_vector_index
+
+BENCH_PREFIX = "vectorbench"
+
+
+def load_config() -> Namespace:
+	config_path = PosixPath(__file__).parent / "index-fics.ini"
+	bench_config = ArgParser(default_config_files=[str(config_path)], ignore_unknown_config_file_keys=True)
+	bench_config.add_argument('-c', '--config', is_config_file=True, help='config file path')
+	api_auth_config = bench_config.add_argument_group(title="API authentication (will be preferred if both are set)")
+	basic_auth_config = bench_config.add_argument_group(title="Basic authentication")
+	api_auth_config.add_argument("--api-id")
+	api_auth_config.add_argument("--api-secret")
+	basic_auth_config.add_argument("--username")
+	basic_auth_config.add_argument("--password")
+	bench_config.add_argument("--es-ca-cert-path", required=True)
+	bench_config.add_argument("--es-hosts", action="append", required=True)
+	bench_config.add_argument("--vaguesearch", type=FileType("rb"), required=True,
+							  help="for STAPI and the default question, story.one.relevance question")
+	bench_config.add_argument("--option", action="append", choices=VECTOR_INDEX_OPTIONS.keys(),
+							  help="vector index option to measure, may be repeated (default: each one), flat is always measured")
+	bench_config.add_argument("--story", action="append", type=int, default=[],
+							  help="story to measure, embedded first if it has no chunks, may be repeated")
+	bench_config.add_argument("--sample-stories", type=int, default=20,
+							  help="stories with the most chunks in chunks-* to measure, besides --story")
+	bench_config.add_argument("--question", action="append", help="relevance question, may be repeated")
+	bench_config.add_argument("--k", type=int, default=10, help="chunks compared for recall@k")
+	bench_config.add_argument("--repeat", type=int, default=5, help="runs of each question on each story")
+	bench_config.add_argument("--keep", action="store_true", help="do not delete the scratch indices")
+	args = bench_config.parse_args()
+	args.vaguesearch = load(args.vaguesearch)
+	return args
+
+
+def setup_elasticsearch(configuration):
+	if configuration.api_id:
+		authentication = {
+			"api_key": (configuration.api_id, configuration.api_secret)
+		}
+	else:
+		authentication = {
+			"basic_auth": (configuration.username, configuration.password)
+		}
+	connections.create_connection(hosts=configuration.es_hosts,
+								  ca_certs=configuration.es_ca_cert_path,
+								  request_timeout=3600, # reindexing the sample waits for completion
+								  **authentication)
+	logging.getLogger('elastic_transport.transport').setLevel(logging.WARNING)
+
+
+def sample_stories(count: int) -> list[int]:
+	# the stories with the most chunks, where the options differ the most
+	conn = connections.get_connection()
+	resp = conn.search(index="chunks-*", size=0, aggs={"stories": {"terms": {"field": "story.id", "size": count}}})
+	return [bucket["key"] for bucket in resp["aggregations"]["stories"]["buckets"]]
+
+
+def store_bench_template(option: str) -> str:
+	conn = connections.get_connection()
+	template = Chunk._index.as_template("ignore").to_dict()
+	del(template["index_patterns"])
+	template["settings"]["number_of_shards"] = 1
+	template["mappings"]["dynamic"] = "strict"
+	apply_vector_index(template, option)
+	bench_pattern = f"{BENCH_PREFIX}-*"
+	conn.indices.put_index_template(name=f"elasticfics-{BENCH_PREFIX}", template=template, index_patterns=[bench_pattern])
+	return bench_pattern
+
+
+def ask(index: str, story_ids: list[int], vectors: list[list[float]], repeat: int) -> tuple[dict, list[float]]:
+	"""
+	:return: the chunk IDs found for each (story, question), wall times of find_related in ms
+	"""
+	found = {}
+	walls = []
+	for story_id in story_ids:
+		for question, vector in enumerate(vectors):
+			try:
+				# warm up, this also caches the chapter texts, which are the same for every option
+				chunks = Chunk.find_related(story_id, vector, index=index)
+			except ValueError:
+				chunks = []
+			found[story_id, question] = [chunk.meta.id for chunk in chunks]
+			for _ in range(repeat):
+				start = perf_counter()
+				try:
+					Chunk.find_related(story_id, vector, index=index)
+				except ValueError:
+					pass
+				walls.append((perf_counter() - start) * 1000)
+	return found, walls
+
+
+def bench_option(option: str, story_ids: list[int], vectors: list[list[float]], configuration: Namespace) -> dict:
+	conn = connections.get_connection()
+	store_bench_template(option)
+	index = f"{BENCH_PREFIX}-{option.replace('_', '-')}"
+	try:
+		conn.indices.delete(index=index)
+	except NotFoundError:
+		pass
+	conn.indices.create(index=index)
+	start = perf_counter()
+	conn.reindex(source={"index": "chunks-*", "query": {"terms": {"story.id": story_ids}}},
+				 dest={"index": index},
+				 wait_for_completion=True,
+				 refresh=True)
+	ingest_seconds = perf_counter() - start
+	conn.indices.forcemerge(index=index, max_num_segments=1)
+	stats = conn.indices.stats(index=index, metric="store,docs")
+	primaries = stats["indices"][index]["primaries"]
+	disk_usage = conn.indices.disk_usage(index=index, run_expensive_tasks=True)
+	found, walls = ask(index, story_ids, vectors, configuration.repeat)
+	result = {
+		"option": option,
+		"index": index,
+		"docs": primaries["docs"]["count"],
+		"ingest s": ingest_seconds,
+		"size MB": primaries["store"]["size_in_bytes"] / 2**20,
+		# the quantized options keep the floats too, for rescoring and reindexing
+		"vectors MB": disk_usage[index]["fields"]["embeddings"]["total_in_bytes"] / 2**20,
+		"wall p50": median(walls),
+		"wall p95": quantiles(walls, n=20)[-1] if len(walls) > 1 else walls[0],
+		"found": found,
+	}
+	if not configuration.keep:
+		conn.indices.delete(index=index)
+	return result
+
+
+def recall_at_k(found: dict, baseline: dict, k: int) -> float:
+	recalls = []
+	for key, expected in baseline.items():
+		expected = set(expected[:k])
+		if not expected:
+			continue
+		recalls.append(len(expected & set(found.get(key, [])[:k])) / len(expected))
+	return mean(recalls) if recalls else 0.0
+
+
+def print_results(results: list[dict], k: int):
+	baseline = results[0]["found"]
+	for result in results:
+		print(f"{result['option']:<10} {result['docs']} chunks, {result['size MB']:.1f} MB "
+			  f"({result['vectors MB']:.1f} MB embeddings), reindexed in {result['ingest s']:.1f}s, "
+			  f"find_related p50 {result['wall p50']:.1f} ms p95 {result['wall p95']:.1f} ms, "
+			  f"recall@{k} {recall_at_k(result['found'], baseline, k):.3f}")
+
+
+if __name__ == "__main__":
+	my_config = load_config()
+	setup_elasticsearch(my_config)
+	from rag_cli import make_embedder, embed_story
+	embedder = make_embedder(my_config)
+	for story in my_config.story:
+		embed_story(embedder, story)
+	story_ids = list(dict.fromkeys(my_config.story + sample_stories(my_config.sample_stories)))
+	if not story_ids:
+		raise SystemExit("No embedded stories in chunks-*, embed some or pass --story")
+
+	embedding_config = my_config.vaguesearch["llms"]["embedding"]
+	prompt = dedent(embedding_config["prompt"]["s2p"]).strip() + " "
+	questions = my_config.question or [dedent(my_config.vaguesearch["story"]["one"]["relevance question"]).strip()]
+	# the questions are embedded once, the stories were embedded above
+	vectors = embedder.final_embed(questions, prompt)
+
+	options = ["flat"] + [option for option in my_config.option or VECTOR_INDEX_OPTIONS.keys() if option != "flat"]
+	print(f"Measuring {', '.join(options)} on {len(story_ids)} stories and {len(questions)} questions")
+	results = [
+		bench_option(option, story_ids, vectors, my_config)
+		for option in options
+	]
+	connections.get_connection().indices.delete_index_template(name=f"elasticfics-{BENCH_PREFIX}")
+	print_results(results, my_config.k)